@@ -87,6 +87,7 @@ class APS(nn.Module):
 class APSAgent(DDPGAgent):
     def __init__(self, update_task_every_step, sf_dim, knn_rms, knn_k, knn_avg,
                  knn_clip, num_init_steps, lstsq_batch_size, update_encoder,
+                 knn_bank_size=0, knn_bank_lists=0, knn_bank_probes=8,
                  **kwargs):
         self.sf_dim = sf_dim
         self.update_task_every_step = update_task_every_step
@@ -117,8 +118,11 @@ class APSAgent(DDPGAgent):
 
         # particle-based entropy
         rms = utils.RMS(self.device)
+        bank = utils.RepBank(knn_bank_size, self.sf_dim, self.device,
+                             knn_bank_lists,
+                             knn_bank_probes) if knn_bank_size > 0 else None
         self.pbe = utils.PBE(rms, knn_clip, knn_k, knn_avg, knn_rms,
-                             self.device)
+                             self.device, bank=bank)
 
         # optimizers
         self.aps_opt = torch.optim.Adam(self.aps.parameters(), lr=self.lr)
@@ -154,13 +158,11 @@ class APSAgent(DDPGAgent):
         self.aps_opt.zero_grad(set_to_none=True)
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.aps_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.aps_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['aps_loss'] = loss.item()
+            metrics['aps_loss'] = loss.detach()
 
         return metrics
 
@@ -207,17 +209,17 @@ class APSAgent(DDPGAgent):
                 intr_reward = intr_ent_reward + intr_sf_reward
 
             if self.use_tb or self.use_wandb:
-                metrics['intr_reward'] = intr_reward.mean().item()
-                metrics['intr_ent_reward'] = intr_ent_reward.mean().item()
-                metrics['intr_sf_reward'] = intr_sf_reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
+                metrics['intr_ent_reward'] = intr_ent_reward.mean().detach()
+                metrics['intr_sf_reward'] = intr_sf_reward.mean().detach()
 
             reward = intr_reward
         else:
             reward = extr_reward
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
         if not self.update_encoder:
             obs = obs.detach()
@@ -283,15 +285,15 @@ class APSAgent(DDPGAgent):
         critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)
 
         if self.use_tb or self.use_wandb:
-            metrics['critic_target_q'] = target_Q.mean().item()
-            metrics['critic_q1'] = Q1.mean().item()
-            metrics['critic_q2'] = Q2.mean().item()
-            metrics['critic_loss'] = critic_loss.item()
+            metrics['critic_target_q'] = target_Q.mean().detach()
+            metrics['critic_q1'] = Q1.mean().detach()
+            metrics['critic_q2'] = Q2.mean().detach()
+            metrics['critic_loss'] = critic_loss.detach()
 
         # optimize critic
         self.critic_opt.zero_grad(set_to_none=True)
-        critic_loss.backward()
-        self.critic_opt.step()
+        self.amp.backward(critic_loss)
+        self.amp.step(self.critic_opt)
         return metrics
 
     def update_actor(self, obs, task, step):
@@ -301,7 +303,6 @@ class APSAgent(DDPGAgent):
         stddev = utils.schedule(self.stddev_schedule, step)
         dist = self.actor(obs, stddev)
         action = dist.sample(clip=self.stddev_clip)
-        log_prob = dist.log_prob(action).sum(-1, keepdim=True)
         Q1, Q2 = self.critic(obs, action, task)
         Q = torch.min(Q1, Q2)
 
@@ -309,12 +310,15 @@ class APSAgent(DDPGAgent):
 
         # optimize actor
         self.actor_opt.zero_grad(set_to_none=True)
-        actor_loss.backward()
-        self.actor_opt.step()
+        self.amp.backward(actor_loss)
+        self.amp.step(self.actor_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['actor_loss'] = actor_loss.item()
-            metrics['actor_logprob'] = log_prob.mean().item()
-            metrics['actor_ent'] = dist.entropy().sum(dim=-1).mean().item()
+            metrics['actor_loss'] = actor_loss.detach()
+        if self.log_diagnostics(step):
+            with torch.no_grad():
+                log_prob = dist.log_prob(action).sum(-1, keepdim=True)
+                metrics['actor_logprob'] = log_prob.mean()
+                metrics['actor_ent'] = dist.entropy().sum(dim=-1).mean()
 
         return metrics
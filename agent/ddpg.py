@@ -1,3 +1,4 @@
+import copy
 from collections import OrderedDict
 
 import hydra
@@ -5,6 +6,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.func import functional_call
 
 import utils
 
@@ -138,8 +140,12 @@ class DDPGAgent(nn.Module):
                  init_critic,
                  use_tb,
                  use_wandb,
+                 diagnostics_every=1,
                  meta_dim=0,
-                 update_encoder=True):
+                 update_encoder=True,
+                 aug='shift',
+                 amp=None,
+                 compile_update=False):
         super().__init__()
         self.reward_free = reward_free
         self.obs_type = obs_type
@@ -152,6 +158,8 @@ class DDPGAgent(nn.Module):
         self.update_every_steps = update_every_steps
         self.use_tb = use_tb
         self.use_wandb = use_wandb
+        self.diagnostics_every = diagnostics_every
+        self._next_diagnostics_step = 0
         self.num_expl_steps = num_expl_steps
         self.stddev_schedule = stddev_schedule
         self.stddev_clip = stddev_clip
@@ -161,7 +169,7 @@ class DDPGAgent(nn.Module):
 
         # models
         if obs_type == 'pixels':
-            self.aug = utils.RandomShiftsAug(pad=4)
+            self.aug = utils.make_aug(aug, pad=4)
             self.encoder = Encoder(obs_shape).to(device)
             self.obs_dim = self.encoder.repr_dim + meta_dim
         else:
@@ -187,10 +195,33 @@ class DDPGAgent(nn.Module):
             self.encoder_opt = None
         self.actor_opt = torch.optim.Adam(self.actor.parameters(), lr=lr)
         self.critic_opt = torch.optim.Adam(self.critic.parameters(), lr=lr)
+        # the workspace runs update under amp.autocast()
+        self.amp = utils.MixedPrecision(amp, device)
 
         self.train()
         self.critic_target.train()
 
+        self.compile_update = compile_update
+        self._compiled = None
+
+    def __getstate__(self):
+        # compiled functions don't pickle, they are rebuilt on first update
+        state = self.__dict__.copy()
+        state['_compiled'] = None
+        return state
+
+    def _compile(self):
+        # cuda graphs on gpu, the batch shapes are static
+        mode = 'reduce-overhead' if 'cuda' in str(self.device) else None
+        return dict(critic_step=torch.compile(self._critic_step,
+                                              mode=mode,
+                                              dynamic=False),
+                    actor_step=torch.compile(self._actor_step,
+                                             mode=mode,
+                                             dynamic=False),
+                    optimizer_step=torch.compile(self._optimizer_step),
+                    target_step=torch.compile(utils.soft_update_params))
+
     def train(self, training=True):
         self.training = training
         self.encoder.train(training)
@@ -214,11 +245,18 @@ class DDPGAgent(nn.Module):
         return meta
 
     def act(self, obs, meta, step, eval_mode):
-        obs = torch.as_tensor(obs, device=self.device).unsqueeze(0)
+        obs = torch.as_tensor(obs, device=self.device)
+        # either a single observation or a batch of them, one per env, with
+        # the meta values stacked the same way
+        batched = obs.ndim > len(self.obs_shape)
+        if not batched:
+            obs = obs.unsqueeze(0)
         h = self.encoder(obs)
         inputs = [h]
         for value in meta.values():
-            value = torch.as_tensor(value, device=self.device).unsqueeze(0)
+            value = torch.as_tensor(value, device=self.device)
+            if not batched:
+                value = value.unsqueeze(0)
             inputs.append(value)
         inpt = torch.cat(inputs, dim=-1)
         #assert obs.shape[-1] == self.obs_shape[-1]
@@ -230,9 +268,21 @@ class DDPGAgent(nn.Module):
             action = dist.sample(clip=None)
             if step < self.num_expl_steps:
                 action.uniform_(-1.0, 1.0)
-        return action.cpu().numpy()[0]
-
-    def update_critic(self, obs, action, reward, discount, next_obs, step):
+        action = action.cpu().numpy()
+        return action if batched else action[0]
+
+    def update_critic(self,
+                      obs,
+                      action,
+                      reward,
+                      discount,
+                      next_obs,
+                      step,
+                      batch=None,
+                      priorities=None):
+        # batch is the sampled batch, prioritized batches carry importance
+        # sampling weights and get their priorities updated with priorities,
+        # the td errors by default
         metrics = dict()
 
         with torch.no_grad():
@@ -244,31 +294,47 @@ class DDPGAgent(nn.Module):
             target_Q = reward + (discount * target_V)
 
         Q1, Q2 = self.critic(obs, action)
-        critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)
+        weights = getattr(batch, 'weights', None)
+        if weights is None:
+            critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)
+        else:
+            critic_loss = (weights * ((Q1 - target_Q)**2 +
+                                      (Q2 - target_Q)**2)).mean()
 
         if self.use_tb or self.use_wandb:
-            metrics['critic_target_q'] = target_Q.mean().item()
-            metrics['critic_q1'] = Q1.mean().item()
-            metrics['critic_q2'] = Q2.mean().item()
-            metrics['critic_loss'] = critic_loss.item()
+            metrics['critic_target_q'] = target_Q.mean().detach()
+            metrics['critic_q1'] = Q1.mean().detach()
+            metrics['critic_q2'] = Q2.mean().detach()
+            metrics['critic_loss'] = critic_loss.detach()
 
         # optimize critic
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
         self.critic_opt.zero_grad(set_to_none=True)
-        critic_loss.backward()
-        self.critic_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(critic_loss)
+        self.amp.step(self.critic_opt, self.encoder_opt)
+
+        if hasattr(batch, 'update_priorities'):
+            if priorities is None:
+                priorities = 0.5 * ((Q1 - target_Q).abs() +
+                                    (Q2 - target_Q).abs())
+            batch.update_priorities(priorities.detach())
         return metrics
 
+    def log_diagnostics(self, step):
+        # the first update and then every diagnostics_every steps
+        if not (self.use_tb or self.use_wandb) or (
+                step < self._next_diagnostics_step):
+            return False
+        self._next_diagnostics_step = step + self.diagnostics_every
+        return True
+
     def update_actor(self, obs, step):
         metrics = dict()
 
         stddev = utils.schedule(self.stddev_schedule, step)
         dist = self.actor(obs, stddev)
         action = dist.sample(clip=self.stddev_clip)
-        log_prob = dist.log_prob(action).sum(-1, keepdim=True)
         Q1, Q2 = self.critic(obs, action)
         Q = torch.min(Q1, Q2)
 
@@ -276,13 +342,16 @@ class DDPGAgent(nn.Module):
 
         # optimize actor
         self.actor_opt.zero_grad(set_to_none=True)
-        actor_loss.backward()
-        self.actor_opt.step()
+        self.amp.backward(actor_loss)
+        self.amp.step(self.actor_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['actor_loss'] = actor_loss.item()
-            metrics['actor_logprob'] = log_prob.mean().item()
-            metrics['actor_ent'] = dist.entropy().sum(dim=-1).mean().item()
+            metrics['actor_loss'] = actor_loss.detach()
+        if self.log_diagnostics(step):
+            with torch.no_grad():
+                log_prob = dist.log_prob(action).sum(-1, keepdim=True)
+                metrics['actor_logprob'] = log_prob.mean()
+                metrics['actor_ent'] = dist.entropy().sum(dim=-1).mean()
 
         return metrics
 
@@ -290,6 +359,88 @@ class DDPGAgent(nn.Module):
         obs = self.aug(obs)
         return self.encoder(obs)
 
+    def _critic_step(self, obs, action, reward, discount, next_obs, stddev):
+        # forward part of the compiled update, metrics stay on the device
+        obs = self.aug_and_encode(obs)
+        with torch.no_grad():
+            next_obs = self.aug_and_encode(next_obs)
+            dist = self.actor(next_obs, stddev)
+            next_action = dist.sample(clip=self.stddev_clip)
+            target_Q1, target_Q2 = self.critic_target(next_obs, next_action)
+            target_V = torch.min(target_Q1, target_Q2)
+            target_Q = reward + (discount * target_V)
+
+        Q1, Q2 = self.critic(obs, action)
+        critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)
+        metrics = torch.stack([
+            reward.mean(),
+            target_Q.mean(),
+            Q1.mean(),
+            Q2.mean(),
+            critic_loss.detach()
+        ])
+        return obs.detach(), critic_loss, metrics
+
+    def _actor_step(self, obs, stddev):
+        dist = self.actor(obs, stddev)
+        action = dist.sample(clip=self.stddev_clip)
+        log_prob = dist.log_prob(action).sum(-1, keepdim=True)
+        Q1, Q2 = self.critic(obs, action)
+        actor_loss = -torch.min(Q1, Q2).mean()
+        metrics = torch.stack([
+            actor_loss.detach(),
+            log_prob.mean(),
+            dist.entropy().sum(dim=-1).mean()
+        ])
+        return actor_loss, metrics
+
+    def _optimizer_step(self, optimizers):
+        for optimizer in optimizers:
+            optimizer.step()
+
+    def _step_compiled(self, optimizers):
+        # scaled fp16 steps go through the grad scaler uncompiled
+        if self.amp.scaler.is_enabled():
+            self.amp.step(*optimizers)
+        else:
+            self._compiled['optimizer_step'](optimizers)
+            self.amp.stepped()
+
+    def _update_compiled(self, obs, action, reward, discount, next_obs, step):
+        if self._compiled is None:
+            self._compiled = self._compile()
+        compiled = self._compiled
+        stddev = torch.as_tensor(utils.schedule(self.stddev_schedule, step),
+                                 device=self.device)
+
+        obs, critic_loss, critic_metrics = compiled['critic_step'](
+            obs, action, reward, discount, next_obs, stddev)
+        optimizers = [self.critic_opt]
+        if self.encoder_opt is not None:
+            self.encoder_opt.zero_grad(set_to_none=True)
+            optimizers.append(self.encoder_opt)
+        self.critic_opt.zero_grad(set_to_none=True)
+        self.amp.backward(critic_loss)
+        self._step_compiled(optimizers)
+
+        actor_loss, actor_metrics = compiled['actor_step'](obs, stddev)
+        self.actor_opt.zero_grad(set_to_none=True)
+        self.amp.backward(actor_loss)
+        self._step_compiled([self.actor_opt])
+
+        compiled['target_step'](self.critic, self.critic_target,
+                                self.critic_target_tau)
+
+        if not (self.use_tb or self.use_wandb):
+            return dict()
+        # cloned, cuda graph outputs are overwritten by the next replay
+        values = torch.cat([critic_metrics, actor_metrics]).detach().clone()
+        keys = [
+            'batch_reward', 'critic_target_q', 'critic_q1', 'critic_q2',
+            'critic_loss', 'actor_loss', 'actor_logprob', 'actor_ent'
+        ]
+        return dict(zip(keys, values))
+
     def update(self, replay_iter, step):
         metrics = dict()
         #import ipdb; ipdb.set_trace()
@@ -301,17 +452,22 @@ class DDPGAgent(nn.Module):
         obs, action, reward, discount, next_obs = utils.to_torch(
             batch, self.device)
 
+        if self.compile_update and not hasattr(batch, 'weights'):
+            return self._update_compiled(obs, action, reward, discount,
+                                         next_obs, step)
+
         # augment and encode
         obs = self.aug_and_encode(obs)
         with torch.no_grad():
             next_obs = self.aug_and_encode(next_obs)
 
         if self.use_tb or self.use_wandb:
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['batch_reward'] = reward.mean().detach()
 
         # update critic
         metrics.update(
-            self.update_critic(obs, action, reward, discount, next_obs, step))
+            self.update_critic(obs, action, reward, discount, next_obs, step,
+                               batch))
 
         # update actor
         metrics.update(self.update_actor(obs.detach(), step))
@@ -321,3 +477,158 @@ class DDPGAgent(nn.Module):
                                  self.critic_target_tau)
 
         return metrics
+
+
+class MultiSeedDDPG:
+    """updates the networks of several DDPGAgents with the same config (one
+    per seed) as one stacked set of parameters with vmapped forward and
+    backward passes. the agents' own parameters become views into the
+    stacked ones, so they still act, eval and save on their own"""
+    def __init__(self, agents):
+        agent = agents[0]
+        assert all(type(a) is DDPGAgent for a in agents)
+        self.agents = agents
+        self.device = agent.device
+        self.aug = agent.aug
+        self.amp = agent.amp
+        self.critic_target_tau = agent.critic_target_tau
+        self.update_every_steps = agent.update_every_steps
+        self.stddev_schedule = agent.stddev_schedule
+        self.stddev_clip = agent.stddev_clip
+        self.use_tb = agent.use_tb
+        self.use_wandb = agent.use_wandb
+
+        self.params = dict()
+        self._base = dict()
+        for name in ['encoder', 'actor', 'critic', 'critic_target']:
+            modules = [getattr(a, name) for a in agents]
+            params, _ = torch.func.stack_module_state(modules)
+            for i, module in enumerate(modules):
+                for key, param in module.named_parameters():
+                    param.data = params[key].data[i]
+            self.params[name] = params
+            self._base[name] = copy.deepcopy(modules[0]).to('meta')
+
+        if agent.encoder_opt is not None:
+            self.encoder_opt = torch.optim.Adam(
+                self.params['encoder'].values(), lr=agent.lr)
+        else:
+            self.encoder_opt = None
+        self.actor_opt = torch.optim.Adam(self.params['actor'].values(),
+                                          lr=agent.lr)
+        self.critic_opt = torch.optim.Adam(self.params['critic'].values(),
+                                           lr=agent.lr)
+
+    def _call(self, name, *args):
+        # args carry a leading seed dim
+        base = self._base[name]
+        return torch.func.vmap(lambda params, *args: functional_call(
+            base, params, args))(self.params[name], *args)
+
+    def _actor(self, obs, stddev):
+        # the distribution is built outside of vmap from the stacked means
+        base = self._base['actor']
+        mu = torch.func.vmap(lambda params, obs: functional_call(
+            base, params, (obs, stddev)).mean)(self.params['actor'], obs)
+        return utils.TruncatedNormal(mu, torch.ones_like(mu) * stddev)
+
+    def aug_and_encode(self, obs):
+        num_seeds = obs.shape[0]
+        obs = self.aug(obs.flatten(0, 1))
+        obs = obs.view(num_seeds, -1, *obs.shape[1:])
+        return self._call('encoder', obs)
+
+    def update_critic(self, obs, action, reward, discount, next_obs, step):
+        metrics = dict()
+
+        with torch.no_grad():
+            stddev = utils.schedule(self.stddev_schedule, step)
+            dist = self._actor(next_obs, stddev)
+            next_action = dist.sample(clip=self.stddev_clip)
+            target_Q1, target_Q2 = self._call('critic_target', next_obs,
+                                              next_action)
+            target_V = torch.min(target_Q1, target_Q2)
+            target_Q = reward + (discount * target_V)
+
+        Q1, Q2 = self._call('critic', obs, action)
+        # one loss per seed, summed so that each seed gets its own gradient
+        critic_loss = ((Q1 - target_Q)**2).mean(dim=(1, 2)) + (
+            (Q2 - target_Q)**2).mean(dim=(1, 2))
+
+        if self.use_tb or self.use_wandb:
+            metrics['critic_target_q'] = target_Q.mean(dim=(1, 2))
+            metrics['critic_q1'] = Q1.mean(dim=(1, 2))
+            metrics['critic_q2'] = Q2.mean(dim=(1, 2))
+            metrics['critic_loss'] = critic_loss
+
+        # optimize critic
+        if self.encoder_opt is not None:
+            self.encoder_opt.zero_grad(set_to_none=True)
+        self.critic_opt.zero_grad(set_to_none=True)
+        self.amp.backward(critic_loss.sum())
+        self.amp.step(self.critic_opt, self.encoder_opt)
+        return metrics
+
+    def update_actor(self, obs, step):
+        metrics = dict()
+
+        stddev = utils.schedule(self.stddev_schedule, step)
+        dist = self._actor(obs, stddev)
+        action = dist.sample(clip=self.stddev_clip)
+        log_prob = dist.log_prob(action).sum(-1, keepdim=True)
+        Q1, Q2 = self._call('critic', obs, action)
+        Q = torch.min(Q1, Q2)
+
+        actor_loss = -Q.mean(dim=(1, 2))
+
+        # optimize actor
+        self.actor_opt.zero_grad(set_to_none=True)
+        self.amp.backward(actor_loss.sum())
+        self.amp.step(self.actor_opt)
+
+        if self.use_tb or self.use_wandb:
+            metrics['actor_loss'] = actor_loss
+            metrics['actor_logprob'] = log_prob.mean(dim=(1, 2))
+            metrics['actor_ent'] = dist.entropy().sum(dim=-1).mean(dim=1)
+
+        return metrics
+
+    def update(self, replay_iters, step):
+        # one replay iterator per seed, returns one metrics dict per seed
+        metrics = dict()
+
+        if step % self.update_every_steps != 0:
+            return [dict() for _ in self.agents]
+
+        batches = [
+            utils.to_torch(next(replay_iter), self.device)
+            for replay_iter in replay_iters
+        ]
+        obs, action, reward, discount, next_obs = [
+            torch.stack(xs) for xs in zip(*batches)
+        ]
+
+        # augment and encode
+        obs = self.aug_and_encode(obs)
+        with torch.no_grad():
+            next_obs = self.aug_and_encode(next_obs)
+
+        if self.use_tb or self.use_wandb:
+            metrics['batch_reward'] = reward.mean(dim=(1, 2))
+
+        # update critic
+        metrics.update(
+            self.update_critic(obs, action, reward, discount, next_obs, step))
+
+        # update actor
+        metrics.update(self.update_actor(obs.detach(), step))
+
+        # update critic target
+        with torch.no_grad():
+            torch._foreach_lerp_(list(self.params['critic_target'].values()),
+                                 list(self.params['critic'].values()),
+                                 self.critic_target_tau)
+
+        return [{k: v[i].detach()
+                 for k, v in metrics.items()}
+                for i in range(len(self.agents))]
@@ -29,8 +29,15 @@ class DIAYN(nn.Module):
 
 
 class DIAYNAgent(DDPGAgent):
-    def __init__(self, update_skill_every_step, skill_dim, diayn_scale,
-                 update_encoder, **kwargs):
+    def __init__(self,
+                 update_skill_every_step,
+                 skill_dim,
+                 diayn_scale,
+                 update_encoder,
+                 intr_reward_weights='post',
+                 **kwargs):
+        assert intr_reward_weights in ('post', 'pre')
+        self.intr_reward_weights = intr_reward_weights
         self.skill_dim = skill_dim
         self.update_skill_every_step = update_skill_every_step
         self.diayn_scale = diayn_scale
@@ -70,25 +77,25 @@ class DIAYNAgent(DDPGAgent):
     def update_diayn(self, skill, next_obs, step):
         metrics = dict()
 
-        loss, df_accuracy = self.compute_diayn_loss(next_obs, skill)
+        loss, df_accuracy, d_pred = self.compute_diayn_loss(next_obs, skill)
 
         self.diayn_opt.zero_grad()
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.diayn_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.diayn_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['diayn_loss'] = loss.item()
+            metrics['diayn_loss'] = loss.detach()
             metrics['diayn_acc'] = df_accuracy
 
-        return metrics
+        return metrics, d_pred.detach()
 
-    def compute_intr_reward(self, skill, next_obs, step):
+    def compute_intr_reward(self, skill, next_obs, step, d_pred=None):
         z_hat = torch.argmax(skill, dim=1)
-        d_pred = self.diayn(next_obs)
+        # d_pred from the update pass skips the forward
+        if d_pred is None:
+            d_pred = self.diayn(next_obs)
         d_pred_log_softmax = F.log_softmax(d_pred, dim=1)
         _, pred_z = torch.max(d_pred_log_softmax, dim=1, keepdim=True)
         reward = d_pred_log_softmax[torch.arange(d_pred.shape[0]),
@@ -112,7 +119,7 @@ class DIAYNAgent(DDPGAgent):
                                     list(
                                         pred_z.size())[0])[0])).float() / list(
                                             pred_z.size())[0]
-        return d_loss, df_accuracy
+        return d_loss, df_accuracy, d_pred
 
     def update(self, replay_iter, step):
         metrics = dict()
@@ -130,20 +137,26 @@ class DIAYNAgent(DDPGAgent):
         next_obs = self.aug_and_encode(next_obs)
 
         if self.reward_free:
-            metrics.update(self.update_diayn(skill, next_obs, step))
+            diayn_metrics, d_pred = self.update_diayn(skill, next_obs, step)
+            metrics.update(diayn_metrics)
 
+            # pre rewards the predictions of the discriminator before this
+            # update
+            if self.intr_reward_weights == 'post':
+                d_pred = None
             with torch.no_grad():
-                intr_reward = self.compute_intr_reward(skill, next_obs, step)
+                intr_reward = self.compute_intr_reward(skill, next_obs, step,
+                                                       d_pred)
 
             if self.use_tb or self.use_wandb:
-                metrics['intr_reward'] = intr_reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
             reward = intr_reward
         else:
             reward = extr_reward
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
         if not self.update_encoder:
             obs = obs.detach()
@@ -8,50 +8,72 @@ import utils
 from agent.ddpg import DDPGAgent
 
 
+def _stack_ensemble_state(state_dict, prefix, n_models):
+    # checkpoints from before the stacked ensemble hold one
+    # Sequential(Linear, ReLU, Linear) per model under prefix.{model}.{layer}
+    for layer in (0, 2):
+        for name in ('weight', 'bias'):
+            keys = [f'{prefix}{i}.{layer}.{name}' for i in range(n_models)]
+            if not all(key in state_dict for key in keys):
+                continue
+            params = torch.stack([state_dict.pop(key) for key in keys])
+            if name == 'bias':
+                params = params.unsqueeze(1)
+            state_dict[f'{prefix}{layer}.{name}'] = params
+
+
 class Disagreement(nn.Module):
     def __init__(self, obs_dim, action_dim, hidden_dim, n_models=5):
         super().__init__()
-        self.ensemble = nn.ModuleList([
-            nn.Sequential(nn.Linear(obs_dim + action_dim, hidden_dim),
-                          nn.ReLU(), nn.Linear(hidden_dim, obs_dim))
-            for _ in range(n_models)
-        ])
+        # all the models run as one batched forward
+        self.n_models = n_models
+        self.ensemble = nn.Sequential(
+            utils.EnsembleLinear(obs_dim + action_dim, hidden_dim, n_models),
+            nn.ReLU(), utils.EnsembleLinear(hidden_dim, obs_dim, n_models))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _stack_ensemble_state(state_dict, prefix + 'ensemble.', self.n_models)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __setstate__(self, state):
+        # pickled agents from before the stacked ensemble
+        super().__setstate__(state)
+        models = self._modules['ensemble']
+        if isinstance(models, nn.ModuleList):
+            old_state = self.state_dict()
+            obs_dim = models[0][2].out_features
+            self.__init__(obs_dim, models[0][0].in_features - obs_dim,
+                          models[0][0].out_features, len(models))
+            self.load_state_dict(old_state)
+            self.to(models[0][0].weight.device)
+            self.train(state['training'])
 
     def forward(self, obs, action, next_obs):
         #import ipdb; ipdb.set_trace()
         assert obs.shape[0] == next_obs.shape[0]
         assert obs.shape[0] == action.shape[0]
 
-        errors = []
-        for model in self.ensemble:
-            next_obs_hat = model(torch.cat([obs, action], dim=-1))
-            model_error = torch.norm(next_obs - next_obs_hat,
-                                     dim=-1,
-                                     p=2,
-                                     keepdim=True)
-            errors.append(model_error)
-
-        return torch.cat(errors, dim=1)
+        next_obs_hat = self.ensemble(torch.cat([obs, action], dim=-1))
+        errors = torch.norm(next_obs - next_obs_hat, dim=-1, p=2)
+        # (batch, n_models)
+        return errors.t()
 
     def get_disagreement(self, obs, action, next_obs):
         assert obs.shape[0] == next_obs.shape[0]
         assert obs.shape[0] == action.shape[0]
 
-        preds = []
-        for model in self.ensemble:
-            next_obs_hat = model(torch.cat([obs, action], dim=-1))
-            preds.append(next_obs_hat)
-        preds = torch.stack(preds, dim=0)
+        preds = self.ensemble(torch.cat([obs, action], dim=-1))
         return torch.var(preds, dim=0).mean(dim=-1)
 
 
 class DisagreementAgent(DDPGAgent):
-    def __init__(self, update_encoder, **kwargs):
+    def __init__(self, update_encoder, n_models=5, **kwargs):
         super().__init__(**kwargs)
         self.update_encoder = update_encoder
 
         self.disagreement = Disagreement(self.obs_dim, self.action_dim,
-                                         self.hidden_dim).to(self.device)
+                                         self.hidden_dim,
+                                         n_models).to(self.device)
 
         # optimizers
         self.disagreement_opt = torch.optim.Adam(
@@ -59,6 +81,14 @@ class DisagreementAgent(DDPGAgent):
 
         self.disagreement.train()
 
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # agents pickled before the stacked ensemble get a new optimizer,
+        # the old one holds the per model parameters
+        params = list(self.disagreement.parameters())
+        if self.disagreement_opt.param_groups[0]['params'][0] is not params[0]:
+            self.disagreement_opt = torch.optim.Adam(params, lr=self.lr)
+
     def update_disagreement(self, obs, action, next_obs, step):
         metrics = dict()
 
@@ -69,13 +99,11 @@ class DisagreementAgent(DDPGAgent):
         self.disagreement_opt.zero_grad(set_to_none=True)
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.disagreement_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.disagreement_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['disagreement_loss'] = loss.item()
+            metrics['disagreement_loss'] = loss.detach()
 
         return metrics
 
@@ -108,14 +136,14 @@ class DisagreementAgent(DDPGAgent):
                                                        step)
 
             if self.use_tb or self.use_wandb:
-                metrics['intr_reward'] = intr_reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
             reward = intr_reward
         else:
             reward = extr_reward
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
         if not self.update_encoder:
             obs = obs.detach()
@@ -164,8 +164,11 @@ class HyperDDPGAgent(nn.Module):
                  init_critic,
                  use_tb,
                  use_wandb,
+                 diagnostics_every=1,
                  meta_dim=0,
-                 update_encoder=True):
+                 update_encoder=True,
+                 aug='shift',
+                 amp=None):
         super().__init__()
         self.reward_free = reward_free
         self.obs_type = obs_type
@@ -178,6 +181,8 @@ class HyperDDPGAgent(nn.Module):
         self.update_every_steps = update_every_steps
         self.use_tb = use_tb
         self.use_wandb = use_wandb
+        self.diagnostics_every = diagnostics_every
+        self._next_diagnostics_step = 0
         self.num_expl_steps = num_expl_steps
         self.stddev_schedule = stddev_schedule
         self.stddev_clip = stddev_clip
@@ -187,7 +192,7 @@ class HyperDDPGAgent(nn.Module):
 
         # models
         if obs_type == 'pixels':
-            self.aug = utils.RandomShiftsAug(pad=4)
+            self.aug = utils.make_aug(aug, pad=4)
             self.encoder = Encoder(obs_shape).to(device)
             self.obs_dim = self.encoder.repr_dim + meta_dim
         else:
@@ -216,6 +221,9 @@ class HyperDDPGAgent(nn.Module):
             self.encoder_opt = None
         self.actor_opt = RiemannianAdam(self.actor.parameters(), lr=lr)
         self.critic_opt = RiemannianAdam(self.critic.parameters(), lr=lr)
+        # the workspace runs update under amp.autocast(), the poincare
+        # layers stay in fp32
+        self.amp = utils.MixedPrecision(amp, device)
 
         self.train()
         self.critic_target.train()
@@ -243,11 +251,18 @@ class HyperDDPGAgent(nn.Module):
         return meta
 
     def act(self, obs, meta, step, eval_mode):
-        obs = torch.as_tensor(obs, device=self.device).unsqueeze(0)
+        obs = torch.as_tensor(obs, device=self.device)
+        # either a single observation or a batch of them, one per env, with
+        # the meta values stacked the same way
+        batched = obs.ndim > len(self.obs_shape)
+        if not batched:
+            obs = obs.unsqueeze(0)
         h = self.encoder(obs)
         inputs = [h]
         for value in meta.values():
-            value = torch.as_tensor(value, device=self.device).unsqueeze(0)
+            value = torch.as_tensor(value, device=self.device)
+            if not batched:
+                value = value.unsqueeze(0)
             inputs.append(value)
         inpt = torch.cat(inputs, dim=-1)
         #assert obs.shape[-1] == self.obs_shape[-1]
@@ -259,7 +274,8 @@ class HyperDDPGAgent(nn.Module):
             action = dist.sample(clip=None)
             if step < self.num_expl_steps:
                 action.uniform_(-1.0, 1.0)
-        return action.cpu().numpy()[0]
+        action = action.cpu().numpy()
+        return action if batched else action[0]
 
     def update_critic(self, obs, action, reward, discount, next_obs, step):
         metrics = dict()
@@ -276,28 +292,33 @@ class HyperDDPGAgent(nn.Module):
         critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)
 
         if self.use_tb or self.use_wandb:
-            metrics['critic_target_q'] = target_Q.mean().item()
-            metrics['critic_q1'] = Q1.mean().item()
-            metrics['critic_q2'] = Q2.mean().item()
-            metrics['critic_loss'] = critic_loss.item()
+            metrics['critic_target_q'] = target_Q.mean().detach()
+            metrics['critic_q1'] = Q1.mean().detach()
+            metrics['critic_q2'] = Q2.mean().detach()
+            metrics['critic_loss'] = critic_loss.detach()
 
         # optimize critic
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
         self.critic_opt.zero_grad(set_to_none=True)
-        critic_loss.backward()
-        self.critic_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(critic_loss)
+        self.amp.step(self.critic_opt, self.encoder_opt)
         return metrics
 
+    def log_diagnostics(self, step):
+        # the first update and then every diagnostics_every steps
+        if not (self.use_tb or self.use_wandb) or (
+                step < self._next_diagnostics_step):
+            return False
+        self._next_diagnostics_step = step + self.diagnostics_every
+        return True
+
     def update_actor(self, obs, step):
         metrics = dict()
 
         stddev = utils.schedule(self.stddev_schedule, step)
         dist = self.actor(obs, stddev)
         action = dist.sample(clip=self.stddev_clip)
-        log_prob = dist.log_prob(action).sum(-1, keepdim=True)
         Q1, Q2 = self.critic(obs, action)
         Q = torch.min(Q1, Q2)
 
@@ -305,13 +326,16 @@ class HyperDDPGAgent(nn.Module):
 
         # optimize actor
         self.actor_opt.zero_grad(set_to_none=True)
-        actor_loss.backward()
-        self.actor_opt.step()
+        self.amp.backward(actor_loss)
+        self.amp.step(self.actor_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['actor_loss'] = actor_loss.item()
-            metrics['actor_logprob'] = log_prob.mean().item()
-            metrics['actor_ent'] = dist.entropy().sum(dim=-1).mean().item()
+            metrics['actor_loss'] = actor_loss.detach()
+        if self.log_diagnostics(step):
+            with torch.no_grad():
+                log_prob = dist.log_prob(action).sum(-1, keepdim=True)
+                metrics['actor_logprob'] = log_prob.mean()
+                metrics['actor_ent'] = dist.entropy().sum(dim=-1).mean()
 
         return metrics
 
@@ -336,7 +360,7 @@ class HyperDDPGAgent(nn.Module):
             next_obs = self.aug_and_encode(next_obs)
 
         if self.use_tb or self.use_wandb:
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['batch_reward'] = reward.mean().detach()
 
         # update critic
         metrics.update(
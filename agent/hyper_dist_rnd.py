@@ -8,7 +8,7 @@ import torch.nn.functional as F
 
 import utils
 from agent.ddpg import DDPGAgent
-from agent.hyper_utils import PoincareDist
+from agent.hyper_utils import PoincareDist, fp32
 import geoopt
 
 class RND(nn.Module):
@@ -48,6 +48,7 @@ class RND(nn.Module):
 
         self.apply(utils.weight_init)
     
+    @fp32
     def dist(self, x, y):
         x, y = self.hyper_ball.expmap0(x), self.hyper_ball.expmap0(y)
         return self.hyper_ball.dist2(x, y)
@@ -90,13 +91,11 @@ class HyperDistRNDAgent(DDPGAgent):
         self.rnd_opt.zero_grad(set_to_none=True)
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.rnd_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.rnd_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['rnd_loss'] = loss.item()
+            metrics['rnd_loss'] = loss.detach()
 
         return metrics
 
@@ -126,7 +125,7 @@ class HyperDistRNDAgent(DDPGAgent):
                 intr_reward = self.compute_intr_reward(obs, step)
 
             if self.use_tb or self.use_wandb:
-                metrics['intr_reward'] = intr_reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
             reward = intr_reward
         else:
             reward = extr_reward
@@ -137,8 +136,8 @@ class HyperDistRNDAgent(DDPGAgent):
             next_obs = self.aug_and_encode(next_obs)
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
             metrics['pred_error_mean'] = self.intrinsic_reward_rms.M
             metrics['pred_error_std'] = torch.sqrt(self.intrinsic_reward_rms.S)
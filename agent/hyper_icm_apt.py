@@ -119,13 +119,11 @@ class HyperICMAPTAgent(HyperDDPGAgent):
         self.icm_opt.zero_grad()
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.icm_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.icm_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['icm_loss'] = loss.item()
+            metrics['icm_loss'] = loss.detach()
 
         return metrics
 
@@ -161,10 +159,10 @@ class HyperICMAPTAgent(HyperDDPGAgent):
             reward = extr_reward
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
             if self.reward_free:
-                metrics['intr_reward'] = intr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
         if not self.update_encoder:
             obs = obs.detach()
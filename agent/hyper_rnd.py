@@ -9,7 +9,7 @@ import torch.nn.functional as F
 import utils
 import geoopt
 from agent.ddpg import DDPGAgent
-from agent.hyper_utils import PoincarePlaneDistance, ClipNorm, apply_sn_until_instance, final_weight_init_hyp_small, PoincareDist
+from agent.hyper_utils import PoincarePlaneDistance, ClipNorm, apply_sn_until_instance, final_weight_init_hyp_small, fp32, PoincareDist
 from radam import RiemannianAdam
 
 class RND(nn.Module):
@@ -81,7 +81,7 @@ class RND(nn.Module):
         # prediction_error = torch.square(target.detach() - prediction).mean(
         #     dim=-1, keepdim=True)
         ## Use hyperdistance
-        prediction_error = self.hyper_ball.dist2(target.detach(), prediction)[:,None]
+        prediction_error = fp32(self.hyper_ball.dist2)(target.detach(), prediction)[:,None]
         return prediction_error
 
 
@@ -112,13 +112,11 @@ class HyperRNDAgent(DDPGAgent):
         self.rnd_opt.zero_grad(set_to_none=True)
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.rnd_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.rnd_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['rnd_loss'] = loss.item()
+            metrics['rnd_loss'] = loss.detach()
 
         return metrics
 
@@ -148,7 +146,7 @@ class HyperRNDAgent(DDPGAgent):
                 intr_reward = self.compute_intr_reward(obs, step)
 
             if self.use_tb or self.use_wandb:
-                metrics['intr_reward'] = intr_reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
             reward = intr_reward
         else:
             reward = extr_reward
@@ -159,8 +157,8 @@ class HyperRNDAgent(DDPGAgent):
             next_obs = self.aug_and_encode(next_obs)
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
             metrics['pred_error_mean'] = self.intrinsic_reward_rms.M
             metrics['pred_error_std'] = torch.sqrt(self.intrinsic_reward_rms.S)
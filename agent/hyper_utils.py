@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -9,6 +11,95 @@ from torch.nn.utils.parametrizations import spectral_norm
     Taken from https://github.com/twitter-research/hyperbolic-rl
 """
 
+
+def fp32(fn):
+    """runs fn outside autocast on fp32 inputs, distances near the boundary
+    of the ball (1 - |x|^2 -> 0) blow up in half precision"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tensors = [a for a in args if torch.is_tensor(a)]
+        device_type = tensors[0].device.type if tensors else 'cpu'
+        args = [a.float() if torch.is_tensor(a) else a for a in args]
+        with torch.autocast(device_type, enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def _poincare_block(x, x_sq, y, y_sq):
+    # x (s, n, d) and y (s, m, d) with their squared norms (s, n, 1) and
+    # (s, 1, m) -> (n, m) distances summed over the s spaces
+    diff_sq = torch.baddbmm(x_sq + y_sq, x, y.transpose(1, 2), alpha=-2)
+    arg = 1 + 2 * diff_sq.clamp(min=0) / (1 - x_sq) / (1 - y_sq)
+    return torch.arccosh(arg.clamp(min=1)).sum(0)
+
+
+@fp32
+def poincare_distance_matrix(x, y=None, num_spaces=1, k=None,
+                             block_size=1024):
+    """pairwise distances between the points x (b1, num_spaces * d) and y
+    (b2, num_spaces * d) of the unit ball, summed over the spaces, with
+    y = x by default. |x - y|^2 comes from |x|^2 + |y|^2 - 2 x.y as one
+    batched matmul per block of block_size x block_size pairs, so no
+    (b1, b2, d) tensor is built. returns the (b1, b2) matrix, or with k
+    only the (b1, k) smallest distances sorted ascending. those are picked
+    on the matmul distances and recomputed elementwise like manual_distance
+    """
+    self_pairs = y is None
+    y = x if y is None else y
+    b1, b2 = x.size(0), y.size(0)
+    xs = x.view(b1, num_spaces, -1).transpose(0, 1)
+    ys = y.view(b2, num_spaces, -1).transpose(0, 1)
+    x_sq = xs.pow(2).sum(-1, keepdim=True)
+    y_sq = ys.pow(2).sum(-1).unsqueeze(1)
+
+    if k is None:
+        rows = []
+        for i in range(0, b1, block_size):
+            rows.append(torch.cat([
+                _poincare_block(xs[:, i:i + block_size],
+                                x_sq[:, i:i + block_size],
+                                ys[:, j:j + block_size],
+                                y_sq[:, :, j:j + block_size])
+                for j in range(0, b2, block_size)
+            ], dim=1))
+        distances = torch.cat(rows)
+        if self_pairs:
+            # exactly 0, the matmul leaves a rounding error under the sqrt
+            distances.diagonal().zero_()
+        return distances
+
+    # running top-k over the column blocks of each row block
+    with torch.no_grad():
+        indices = []
+        for i in range(0, b1, block_size):
+            best_dist = best_idx = None
+            for j in range(0, b2, block_size):
+                dist = _poincare_block(xs[:, i:i + block_size],
+                                       x_sq[:, i:i + block_size],
+                                       ys[:, j:j + block_size],
+                                       y_sq[:, :, j:j + block_size])
+                dist, idx = dist.topk(min(k, dist.size(1)),
+                                      dim=1,
+                                      largest=False)
+                idx += j
+                if best_dist is not None:
+                    dist = torch.cat([best_dist, dist], dim=1)
+                    idx = torch.cat([best_idx, idx], dim=1)
+                    dist, pos = dist.topk(k, dim=1, largest=False)
+                    idx = idx.gather(1, pos)
+                best_dist, best_idx = dist, idx
+            indices.append(best_idx)
+        idx = torch.cat(indices)
+    diff_sq = (x.view(b1, 1, num_spaces, -1) -
+               y.view(b2, num_spaces, -1)[idx]).pow(2).sum(-1)
+    points_sq = x_sq.squeeze(-1).t().unsqueeze(1)
+    other_points_sq = y_sq.squeeze(1).t()[idx]
+    distances = torch.arccosh(1 + 2 * diff_sq / (1 - points_sq) /
+                              (1 - other_points_sq)).sum(-1)
+    distances, _ = distances.sort(dim=1)
+    return distances
+
+
 class PoincareDist:
     def __init__(self, c=1.0, project_input=True, euclidean_inputs=True):
         self.project_input = project_input
@@ -23,18 +114,19 @@ class PoincareDist:
                     1 - other_points.pow(2).sum(-1)))
         return dist
 
+    @fp32
     def distance(self, x, y):
         if self.euclidean_inputs:
             x = self.map_to_ball(x)
             y = self.map_to_ball(y)
         return self.manual_distance(x, y)
 
-    def distance_matrix(self, input):
+    @fp32
+    def distance_matrix(self, input, k=None):
+        # (b, b), or the (b, k) nearest distances with k
         if self.euclidean_inputs:
             input = self.map_to_ball(input)
-        input = input[:, None, :]
-        distances = self.manual_distance(input.unsqueeze(0), input.unsqueeze(1))
-        return distances.sum(-1)
+        return poincare_distance_matrix(input, k=k)
 
 
 class PoincarePlaneDistance(torch.nn.Module):
@@ -115,17 +207,16 @@ class PoincarePlaneDistance(torch.nn.Module):
                     1 - other_points.pow(2).sum(-1)))
         return dist
 
-    def distance_matrix(self, input, euclidean_inputs=True, cpu=False):
+    @fp32
+    def distance_matrix(self, input, euclidean_inputs=True, cpu=False, k=None):
+        # (b, b) summed over the spaces, or the (b, k) nearest distances with k
         if euclidean_inputs:
             input = self.map_to_ball(input)
-        input_batch_dims = input.size()[:-1]
-        input = input.view(*input_batch_dims, self.num_spaces, self.dimensions_per_space)
         if cpu:
             input = input.cpu()
-        distances = self.manual_distance(input.unsqueeze(0), input.unsqueeze(1))
-
-        return distances.sum(-1)
+        return poincare_distance_matrix(input, num_spaces=self.num_spaces, k=k)
 
+    @fp32
     def distance_to_space(self, input, other, euclidean_inputs):
         if euclidean_inputs:
             input = self.map_to_ball(input)
@@ -136,6 +227,7 @@ class PoincarePlaneDistance(torch.nn.Module):
         summed_dists = self.ball.dist(x=input, y=other).sum(-1)
         return summed_dists.view(input_batch_dims)
 
+    @fp32
     def forward(self, input):  # input bs x in_feat
         input_batch_dims = input.size()[:-1]
         input = input.view(-1, self.num_spaces, self.dimensions_per_space)
@@ -157,6 +249,7 @@ class PoincarePlaneDistance(torch.nn.Module):
         distance = distance.view(*input_batch_dims, self.num_planes)
         return distance * self.logits_multiplier
 
+    @fp32
     def forward_rs(self, input):  # input bs x in_feat
         input_batch_dims = input.size()[:-1]
         input = input.view(-1, self.num_spaces, self.dimensions_per_space)
@@ -43,10 +43,16 @@ class ICM(nn.Module):
 
 
 class ICMAgent(DDPGAgent):
-    def __init__(self, icm_scale, update_encoder, **kwargs):
+    def __init__(self,
+                 icm_scale,
+                 update_encoder,
+                 intr_reward_weights='post',
+                 **kwargs):
         super().__init__(**kwargs)
+        assert intr_reward_weights in ('post', 'pre')
         self.icm_scale = icm_scale
         self.update_encoder = update_encoder
+        self.intr_reward_weights = intr_reward_weights
 
         self.icm = ICM(self.obs_dim, self.action_dim,
                        self.hidden_dim).to(self.device)
@@ -66,18 +72,23 @@ class ICMAgent(DDPGAgent):
         self.icm_opt.zero_grad(set_to_none=True)
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.icm_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.icm_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['icm_loss'] = loss.item()
+            metrics['icm_loss'] = loss.detach()
 
-        return metrics
+        return metrics, forward_error.detach()
 
-    def compute_intr_reward(self, obs, action, next_obs, step):
-        forward_error, _ = self.icm(obs, action, next_obs)
+    def compute_intr_reward(self,
+                            obs,
+                            action,
+                            next_obs,
+                            step,
+                            forward_error=None):
+        # forward_error from the update pass skips the forward
+        if forward_error is None:
+            forward_error, _ = self.icm(obs, action, next_obs)
 
         reward = forward_error * self.icm_scale
         reward = torch.log(reward + 1.0)
@@ -99,21 +110,26 @@ class ICMAgent(DDPGAgent):
             next_obs = self.aug_and_encode(next_obs)
 
         if self.reward_free:
-            metrics.update(self.update_icm(obs, action, next_obs, step))
+            icm_metrics, forward_error = self.update_icm(
+                obs, action, next_obs, step)
+            metrics.update(icm_metrics)
 
+            # pre rewards the errors of the icm weights before this update
+            if self.intr_reward_weights == 'post':
+                forward_error = None
             with torch.no_grad():
                 intr_reward = self.compute_intr_reward(obs, action, next_obs,
-                                                       step)
+                                                       step, forward_error)
 
             if self.use_tb or self.use_wandb:
-                metrics['intr_reward'] = intr_reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
             reward = intr_reward
         else:
             reward = extr_reward
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
         if not self.update_encoder:
             obs = obs.detach()
@@ -122,7 +138,8 @@ class ICMAgent(DDPGAgent):
         # update critic
         metrics.update(
             self.update_critic(obs.detach(), action, reward, discount,
-                               next_obs.detach(), step))
+                               next_obs.detach(), step, batch,
+                               intr_reward if self.reward_free else None))
 
         # update actor
         metrics.update(self.update_actor(obs.detach(), step))
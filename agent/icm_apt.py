@@ -54,7 +54,8 @@ class ICM(nn.Module):
 
 class ICMAPTAgent(DDPGAgent):
     def __init__(self, icm_scale, knn_rms, knn_k, knn_avg, knn_clip,
-                 update_encoder, icm_rep_dim, **kwargs):
+                 update_encoder, icm_rep_dim, knn_bank_size=0,
+                 knn_bank_lists=0, knn_bank_probes=8, **kwargs):
         super().__init__(**kwargs)
 
         self.icm_scale = icm_scale
@@ -70,8 +71,11 @@ class ICMAPTAgent(DDPGAgent):
 
         # particle-based entropy
         rms = utils.RMS(self.device)
+        bank = utils.RepBank(knn_bank_size, icm_rep_dim, self.device,
+                             knn_bank_lists,
+                             knn_bank_probes) if knn_bank_size > 0 else None
         self.pbe = utils.PBE(rms, knn_clip, knn_k, knn_avg, knn_rms,
-                             self.device)
+                             self.device, bank=bank)
 
     def update_icm(self, obs, action, next_obs, step):
         metrics = dict()
@@ -83,13 +87,11 @@ class ICMAPTAgent(DDPGAgent):
         self.icm_opt.zero_grad()
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.icm_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.icm_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['icm_loss'] = loss.item()
+            metrics['icm_loss'] = loss.detach()
 
         return metrics
 
@@ -125,10 +127,10 @@ class ICMAPTAgent(DDPGAgent):
             reward = extr_reward
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
             if self.reward_free:
-                metrics['intr_reward'] = intr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
         if not self.update_encoder:
             obs = obs.detach()
@@ -95,11 +95,12 @@ class ProtoAgent(DDPGAgent):
         C = F.normalize(C, dim=1, p=2)
         self.protos.weight.data.copy_(C)
 
-    def compute_intr_reward(self, obs, step):
+    def compute_intr_reward(self, obs, step, cache=None):
         self.normalize_protos()
         # find a candidate for each prototype
         with torch.no_grad():
-            z = self.encoder(obs)
+            z = self.encoder(obs) if cache is None else cache(
+                self.encoder, obs)
             z = self.predictor(z)
             z = F.normalize(z, dim=1, p=2)
             scores = self.protos(z).T
@@ -143,10 +144,10 @@ class ProtoAgent(DDPGAgent):
         # loss
         loss = -(q_t * log_p_s).sum(dim=1).mean()
         if self.use_tb or self.use_wandb:
-            metrics['repr_loss'] = loss.item()
+            metrics['repr_loss'] = loss.detach()
         self.proto_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.proto_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.proto_opt)
 
         return metrics
 
@@ -164,25 +165,29 @@ class ProtoAgent(DDPGAgent):
         with torch.no_grad():
             obs = self.aug(obs)
             next_obs = self.aug(next_obs)
+        # encoder passes over the batch, shared while the encoder is unchanged
+        cache = utils.FeatureCache()
 
         if self.reward_free:
             metrics.update(self.update_proto(obs, next_obs, step))
 
             with torch.no_grad():
-                intr_reward = self.compute_intr_reward(next_obs, step)
+                intr_reward = self.compute_intr_reward(next_obs, step, cache)
 
             if self.use_tb or self.use_wandb:
-                metrics['intr_reward'] = intr_reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
             reward = intr_reward
         else:
             reward = extr_reward
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
-        obs = self.encoder(obs)
-        next_obs = self.encoder(next_obs)
+        # the critic and actor only get detached features
+        with torch.no_grad():
+            obs = cache(self.encoder, obs)
+            next_obs = cache(self.encoder, next_obs)
 
         if not self.update_encoder:
             obs = obs.detach()
@@ -45,21 +45,37 @@ class RND(nn.Module):
 
         self.apply(utils.weight_init)
 
-    def forward(self, obs):
-        obs = self.aug(obs)
+    def normalize(self, obs):
         obs = self.normalize_obs(obs)
-        obs = torch.clamp(obs, -self.clip_val, self.clip_val)
-        prediction, target = self.predictor(obs), self.target(obs)
+        return torch.clamp(obs, -self.clip_val, self.clip_val)
+
+    def forward(self, obs, cache=None):
+        # with a cache, the augmentation, the normalized obs and the frozen
+        # target are shared by the passes over the same batch
+        if cache is None:
+            obs = self.normalize(self.aug(obs))
+            target = self.target(obs)
+        else:
+            obs = cache(self.normalize, cache(self.aug, obs))
+            target = cache(self.target, obs)
+        prediction = self.predictor(obs)
         prediction_error = torch.square(target.detach() - prediction).mean(
             dim=-1, keepdim=True)
         return prediction_error
 
 
 class RNDAgent(DDPGAgent):
-    def __init__(self, rnd_rep_dim, update_encoder, rnd_scale=1., **kwargs):
+    def __init__(self,
+                 rnd_rep_dim,
+                 update_encoder,
+                 rnd_scale=1.,
+                 intr_reward_weights='post',
+                 **kwargs):
         super().__init__(**kwargs)
+        assert intr_reward_weights in ('post', 'pre')
         self.rnd_scale = rnd_scale
         self.update_encoder = update_encoder
+        self.intr_reward_weights = intr_reward_weights
 
         self.rnd = RND(self.obs_dim, self.hidden_dim, rnd_rep_dim,
                        self.encoder, self.aug, self.obs_shape,
@@ -71,28 +87,28 @@ class RNDAgent(DDPGAgent):
 
         self.rnd.train()
 
-    def update_rnd(self, obs, step):
+    def update_rnd(self, obs, step, cache=None):
         metrics = dict()
 
-        prediction_error = self.rnd(obs)
+        prediction_error = self.rnd(obs, cache)
 
         loss = prediction_error.mean()
 
         self.rnd_opt.zero_grad(set_to_none=True)
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.rnd_opt.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.rnd_opt, self.encoder_opt)
 
         if self.use_tb or self.use_wandb:
-            metrics['rnd_loss'] = loss.item()
+            metrics['rnd_loss'] = loss.detach()
 
-        return metrics
+        return metrics, prediction_error.detach()
 
-    def compute_intr_reward(self, obs, step):
-        prediction_error = self.rnd(obs)
+    def compute_intr_reward(self, obs, step, cache=None, prediction_error=None):
+        # prediction_error from the update pass skips the forward
+        if prediction_error is None:
+            prediction_error = self.rnd(obs, cache)
         _, intr_reward_var = self.intrinsic_reward_rms(prediction_error)
         reward = self.rnd_scale * prediction_error / (
             torch.sqrt(intr_reward_var) + 1e-8)
@@ -108,28 +124,37 @@ class RNDAgent(DDPGAgent):
         obs, action, extr_reward, discount, next_obs = utils.to_torch(
             batch, self.device)
 
+        # one augmented batch for rnd and the critic
+        cache = utils.FeatureCache()
+
         # update RND first
         if self.reward_free:
             # note: one difference is that the RND module is updated off policy
-            metrics.update(self.update_rnd(obs, step))
+            rnd_metrics, prediction_error = self.update_rnd(obs, step, cache)
+            metrics.update(rnd_metrics)
 
+            # pre rewards the errors of the rnd weights before this update
+            if self.intr_reward_weights == 'post':
+                prediction_error = None
             with torch.no_grad():
-                intr_reward = self.compute_intr_reward(obs, step)
+                intr_reward = self.compute_intr_reward(obs, step, cache,
+                                                       prediction_error)
 
             if self.use_tb or self.use_wandb:
-                metrics['intr_reward'] = intr_reward.mean().item()
+                metrics['intr_reward'] = intr_reward.mean().detach()
             reward = intr_reward
         else:
             reward = extr_reward
 
-        # augment and encode
-        obs = self.aug_and_encode(obs)
+        # augment and encode, the critic and actor only get detached
+        # features so no graph is needed
         with torch.no_grad():
+            obs = self.encoder(cache(self.aug, obs))
             next_obs = self.aug_and_encode(next_obs)
 
         if self.use_tb or self.use_wandb:
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
             metrics['pred_error_mean'] = self.intrinsic_reward_rms.M
             metrics['pred_error_std'] = torch.sqrt(self.intrinsic_reward_rms.S)
@@ -141,7 +166,8 @@ class RNDAgent(DDPGAgent):
         # update critic
         metrics.update(
             self.update_critic(obs.detach(), action, reward, discount,
-                               next_obs.detach(), step))
+                               next_obs.detach(), step, batch,
+                               intr_reward if self.reward_free else None))
 
         # update actor
         metrics.update(self.update_actor(obs.detach(), step))
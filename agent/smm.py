@@ -214,12 +214,10 @@ class SMMAgent(DDPGAgent):
         self.vae_optimizer.zero_grad()
         if self.encoder_opt is not None:
             self.encoder_opt.zero_grad(set_to_none=True)
-        loss.backward()
-        self.vae_optimizer.step()
-        if self.encoder_opt is not None:
-            self.encoder_opt.step()
+        self.amp.backward(loss)
+        self.amp.step(self.vae_optimizer, self.encoder_opt)
 
-        metrics['loss_vae'] = loss.cpu().item()
+        metrics['loss_vae'] = loss.detach()
 
         return metrics, h_s_z
 
@@ -229,10 +227,10 @@ class SMMAgent(DDPGAgent):
         h_z_s = self.smm.loss(logits, z).unsqueeze(-1)
         loss = h_z_s.mean()
         self.pred_optimizer.zero_grad()
-        loss.backward()
-        self.pred_optimizer.step()
+        self.amp.backward(loss)
+        self.amp.step(self.pred_optimizer)
 
-        metrics['loss_pred'] = loss.cpu().item()
+        metrics['loss_pred'] = loss.detach()
 
         return metrics, h_z_s
 
@@ -269,9 +267,9 @@ class SMMAgent(DDPGAgent):
         if self.use_tb or self.use_wandb:
             metrics.update(vae_metrics)
             metrics.update(pred_metrics)
-            metrics['intr_reward'] = intr_reward.mean().item()
-            metrics['extr_reward'] = extr_reward.mean().item()
-            metrics['batch_reward'] = reward.mean().item()
+            metrics['intr_reward'] = intr_reward.mean().detach()
+            metrics['extr_reward'] = extr_reward.mean().detach()
+            metrics['batch_reward'] = reward.mean().detach()
 
         if not self.update_encoder:
             obs_z = obs_z.detach()
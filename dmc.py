@@ -1,4 +1,7 @@
+import atexit
+import multiprocessing as mp
 from collections import OrderedDict, deque
+from multiprocessing import shared_memory
 from typing import Any, NamedTuple
 
 import dm_env
@@ -299,6 +302,166 @@ def _make_dmc(obs_type, domain, task, frame_stack, action_repeat, seed):
     return env
 
 
+class VectorEnv:
+    """steps a number of environments in lockstep, time steps and actions
+    are exchanged as lists with one entry per environment"""
+    def __init__(self, envs):
+        self._envs = envs
+        self._actions = None
+
+    def __len__(self):
+        return len(self._envs)
+
+    def reset(self, env_id=None):
+        if env_id is None:
+            return [env.reset() for env in self._envs]
+        return self._envs[env_id].reset()
+
+    def step_async(self, actions):
+        self._actions = actions
+
+    def step_wait(self):
+        time_steps = [
+            env.step(action) for env, action in zip(self._envs, self._actions)
+        ]
+        self._actions = None
+        return time_steps
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def render(self, height, width, camera_id=0):
+        # renders the first environment, for video
+        return self._envs[0].physics.render(height=height,
+                                            width=width,
+                                            camera_id=camera_id)
+
+    def observation_spec(self):
+        return self._envs[0].observation_spec()
+
+    def action_spec(self):
+        return self._envs[0].action_spec()
+
+
+def _async_env_worker(conn, make_args):
+    env = make(*make_args)
+    conn.send((env.observation_spec(), env.action_spec()))
+    shm = shared_memory.SharedMemory(name=conn.recv())
+    spec = env.observation_spec()
+    obs = np.ndarray(spec.shape, dtype=spec.dtype, buffer=shm.buf)
+    try:
+        while True:
+            cmd, action = conn.recv()
+            if cmd == 'reset':
+                time_step = env.reset()
+            elif cmd == 'step':
+                time_step = env.step(action)
+            elif cmd == 'render':
+                conn.send(env.physics.render(**action))
+                continue
+            else:
+                break
+            # the observation goes through shared memory, the rest is small
+            obs[...] = time_step.observation
+            conn.send((time_step.step_type, time_step.action,
+                       time_step.reward, time_step.discount))
+    finally:
+        del obs
+        shm.close()
+        conn.close()
+
+
+class AsyncVectorEnv:
+    """same interface as VectorEnv, but each environment runs in its own
+    process so that stepping them overlaps with the learner between
+    step_async and step_wait"""
+    def __init__(self, make_args):
+        ctx = mp.get_context('spawn')
+        self._conns = []
+        self._procs = []
+        for args in make_args:
+            conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_async_env_worker,
+                               args=(child_conn, args),
+                               daemon=True)
+            proc.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+        self._shms = []
+        self._obs = []
+        for conn in self._conns:
+            self._obs_spec, self._action_spec = conn.recv()
+            spec = self._obs_spec
+            size = max(1, int(np.prod(spec.shape)) * spec.dtype.itemsize)
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            conn.send(shm.name)
+            self._shms.append(shm)
+            self._obs.append(
+                np.ndarray(spec.shape, dtype=spec.dtype, buffer=shm.buf))
+        self._closed = False
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._conns)
+
+    def _receive(self, env_id):
+        step_type, action, reward, discount = self._conns[env_id].recv()
+        # copied out, the worker overwrites the buffer on its next step
+        return ExtendedTimeStep(observation=self._obs[env_id].copy(),
+                                step_type=step_type,
+                                action=action,
+                                reward=reward,
+                                discount=discount)
+
+    def reset(self, env_id=None):
+        if env_id is not None:
+            self._conns[env_id].send(('reset', None))
+            return self._receive(env_id)
+        for conn in self._conns:
+            conn.send(('reset', None))
+        return [self._receive(env_id) for env_id in range(len(self))]
+
+    def step_async(self, actions):
+        for conn, action in zip(self._conns, actions):
+            conn.send(('step', action))
+
+    def step_wait(self):
+        return [self._receive(env_id) for env_id in range(len(self))]
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def render(self, height, width, camera_id=0):
+        self._conns[0].send(
+            ('render', dict(height=height, width=width, camera_id=camera_id)))
+        return self._conns[0].recv()
+
+    def observation_spec(self):
+        return self._obs_spec
+
+    def action_spec(self):
+        return self._action_spec
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for conn in self._conns:
+            try:
+                conn.send(('close', None))
+            except (BrokenPipeError, OSError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=5)
+        self._obs = []
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+
+
 def make(name, obs_type, frame_stack, action_repeat, seed):
     assert obs_type in ['states', 'pixels']
     domain, task = name.split('_', 1)
@@ -315,3 +478,17 @@ def make(name, obs_type, frame_stack, action_repeat, seed):
     env = action_scale.Wrapper(env, minimum=-1.0, maximum=+1.0)
     env = ExtendedTimeStepWrapper(env)
     return env
+
+
+def make_vector(name,
+                obs_type,
+                frame_stack,
+                action_repeat,
+                seed,
+                num_envs,
+                async_envs=False):
+    make_args = [(name, obs_type, frame_stack, action_repeat, seed + i)
+                 for i in range(num_envs)]
+    if async_envs:
+        return AsyncVectorEnv(make_args)
+    return VectorEnv([make(*args) for args in make_args])
@@ -7,17 +7,21 @@ import os
 os.environ['MKL_SERVICE_FORCE_INTEL'] = '1'
 os.environ['MUJOCO_GL'] = 'egl'
 
+import copy
 from pathlib import Path
+from queue import Empty
 
 import hydra
 import numpy as np
+import omegaconf
 import torch
 from dm_env import specs
 
 import dmc
 import utils
+from agent.ddpg import MultiSeedDDPG
 from logger import Logger
-from replay_buffer import ReplayBufferStorage, make_replay_loader
+from replay_buffer import make_replay_loader, make_replay_storage
 from video import TrainVideoRecorder, VideoRecorder
 
 import wandb
@@ -33,9 +37,63 @@ def make_agent(obs_type, obs_spec, action_spec, num_expl_steps, cfg):
     return hydra.utils.instantiate(cfg)
 
 
+def _cpu_cfg(cfg):
+    # plain copy of the config for child processes, with the agent on cpu
+    cfg = omegaconf.OmegaConf.create(
+        omegaconf.OmegaConf.to_container(cfg, resolve=True))
+    cfg.device = cfg.agent.device = 'cpu'
+    return cfg
+
+
+def _evaluate(agent, eval_env, meta, num_episodes, global_step, global_frame,
+              video_recorder):
+    # runs the episodes len(eval_env) at a time with one batched act call
+    # per step, the video follows the first env of the first round
+    step, episode, total_reward = 0, 0, 0
+    meta = {k: np.stack([v] * len(eval_env)) for k, v in meta.items()}
+    while episode < num_episodes:
+        num_active = min(len(eval_env), num_episodes - episode)
+        time_steps = eval_env.reset()
+        video_recorder.init(eval_env, enabled=(episode == 0))
+        done = np.arange(len(eval_env)) >= num_active
+        while not done.all():
+            obs = np.stack([time_step.observation for time_step in time_steps])
+            with torch.no_grad(), utils.eval_mode(agent):
+                actions = agent.act(obs, meta, global_step, eval_mode=True)
+            time_steps = eval_env.step(actions)
+            if not done[0]:
+                video_recorder.record(eval_env)
+            for env_id, time_step in enumerate(time_steps):
+                if not done[env_id]:
+                    total_reward += time_step.reward
+                    step += 1
+                    done[env_id] = time_step.last()
+
+        episode += num_active
+        video_recorder.save(f'{global_frame}.mp4')
+    return total_reward / episode, step / episode
+
+
+def _background_eval(cfg, params, meta, global_step, result_queue):
+    # runs in its own process on a cpu copy of the actor and encoder
+    torch.set_num_threads(1)
+    utils.set_seed_everywhere(cfg.seed)
+    eval_env = dmc.make_vector(cfg.task, cfg.obs_type, cfg.frame_stack,
+                               cfg.action_repeat, cfg.seed, cfg.num_eval_envs)
+    agent = make_agent(cfg.obs_type, eval_env.observation_spec(),
+                       eval_env.action_spec(),
+                       cfg.num_seed_frames // cfg.action_repeat, cfg.agent)
+    agent.actor.load_state_dict(params['actor'])
+    agent.encoder.load_state_dict(params['encoder'])
+    result_queue.put(
+        _evaluate(agent, eval_env, meta, cfg.num_eval_episodes, global_step,
+                  global_step * cfg.action_repeat, VideoRecorder(None)))
+
+
 class Workspace:
-    def __init__(self, cfg):
-        self.work_dir = Path.cwd()
+    def __init__(self, cfg, work_dir=None):
+        self.work_dir = Path.cwd() if work_dir is None else work_dir
+        self.work_dir.mkdir(exist_ok=True)
         print(f'workspace: {self.work_dir}')
 
         self.cfg = cfg
@@ -48,10 +106,17 @@ class Workspace:
                              use_wandb=cfg.use_wandb)
         # create envs
 
-        self.train_env = dmc.make(cfg.task, cfg.obs_type, cfg.frame_stack,
-                                  cfg.action_repeat, cfg.seed)
-        self.eval_env = dmc.make(cfg.task, cfg.obs_type, cfg.frame_stack,
-                                 cfg.action_repeat, cfg.seed)
+        self.train_env = dmc.make_vector(cfg.task, cfg.obs_type,
+                                         cfg.frame_stack, cfg.action_repeat,
+                                         cfg.seed, cfg.num_envs,
+                                         cfg.async_envs)
+        if not cfg.background_eval:
+            self.eval_env = dmc.make_vector(cfg.task, cfg.obs_type,
+                                            cfg.frame_stack,
+                                            cfg.action_repeat, cfg.seed,
+                                            cfg.num_eval_envs,
+                                            cfg.async_envs)
+        self._eval_proc = None
 
         # create agent
         self.agent = make_agent(cfg.obs_type,
@@ -73,15 +138,23 @@ class Workspace:
                       specs.Array((1,), np.float32, 'discount'))
 
         # create data storage
-        self.replay_storage = ReplayBufferStorage(data_specs, meta_specs,
-                                                  self.work_dir / 'buffer')
+        frame_stack = cfg.frame_stack if (cfg.obs_type == 'pixels' and
+                                          cfg.replay_dedup_frames) else 1
+        self.replay_storage = make_replay_storage(cfg.replay_buffer_format,
+                                                  data_specs, meta_specs,
+                                                  self.work_dir / 'buffer',
+                                                  cfg.replay_buffer_size,
+                                                  cfg.device, frame_stack,
+                                                  cfg.replay_async_write)
 
         # create replay buffer
         self.replay_loader = make_replay_loader(self.replay_storage,
                                                 cfg.replay_buffer_size,
                                                 cfg.batch_size,
                                                 cfg.replay_buffer_num_workers,
-                                                False, cfg.nstep, cfg.discount)
+                                                False, cfg.nstep, cfg.discount,
+                                                cfg.prioritized_replay,
+                                                cfg.per_alpha, cfg.per_beta)
         self._replay_iter = None
 
         # create video recorders
@@ -113,33 +186,72 @@ class Workspace:
         return self._replay_iter
 
     def eval(self):
-        step, episode, total_reward = 0, 0, 0
-        eval_until_episode = utils.Until(self.cfg.num_eval_episodes)
         meta = self.agent.init_meta()
-        while eval_until_episode(episode):
-            time_step = self.eval_env.reset()
-            self.video_recorder.init(self.eval_env, enabled=(episode == 0))
-            while not time_step.last():
-                with torch.no_grad(), utils.eval_mode(self.agent):
-                    action = self.agent.act(time_step.observation,
-                                            meta,
+        eval_info = (self.global_step, self.global_episode,
+                     self.timer.total_time())
+        if not self.cfg.background_eval:
+            result = _evaluate(self.agent, self.eval_env, meta,
+                               self.cfg.num_eval_episodes, self.global_step,
+                               self.global_frame, self.video_recorder)
+            self._log_eval(result, *eval_info)
+            return
+
+        # one background eval at a time, it runs on the weights as they are
+        # now and is logged under this step once it finishes
+        self.collect_eval(block=True)
+        params = {
+            name: {
+                k: v.detach().cpu().clone()
+                for k, v in module.state_dict().items()
+            }
+            for name, module in dict(actor=self.agent.actor,
+                                     encoder=self.agent.encoder).items()
+        }
+        ctx = torch.multiprocessing.get_context('spawn')
+        self._eval_queue = ctx.Queue()
+        self._eval_proc = ctx.Process(target=_background_eval,
+                                      args=(_cpu_cfg(self.cfg), params, meta,
                                             self.global_step,
-                                            eval_mode=True)
-                time_step = self.eval_env.step(action)
-                self.video_recorder.record(self.eval_env)
-                total_reward += time_step.reward
-                step += 1
-
-            episode += 1
-            self.video_recorder.save(f'{self.global_frame}.mp4')
-
-        with self.logger.log_and_dump_ctx(self.global_frame, ty='eval') as log:
-            log('episode_reward', total_reward / episode)
-            log('episode_length', step * self.cfg.action_repeat / episode)
-            log('episode', self.global_episode)
-            log('step', self.global_step)
+                                            self._eval_queue),
+                                      daemon=True)
+        self._eval_proc.start()
+        self._eval_info = eval_info
+
+    def collect_eval(self, block=False):
+        # logs the background eval if it has finished
+        if self._eval_proc is None:
+            return
+        try:
+            result = self._eval_queue.get(block=block)
+        except Empty:
+            if self._eval_proc.is_alive():
+                return
+            raise RuntimeError('background eval exited without a result')
+        self._eval_proc.join()
+        self._eval_proc = None
+        self._log_eval(result, *self._eval_info)
+
+    def _log_eval(self, result, step, episode, total_time):
+        episode_reward, episode_length = result
+        frame = step * self.cfg.action_repeat
+        with self.logger.log_and_dump_ctx(frame, ty='eval') as log:
+            log('total_time', total_time)
+            log('episode_reward', episode_reward)
+            log('episode_length', episode_length * self.cfg.action_repeat)
+            log('episode', episode)
+            log('step', step)
 
     def train(self):
+        for steps in self._train_loop():
+            for step in steps:
+                with self.agent.amp.autocast():
+                    metrics = self.agent.update(self.replay_iter, step)
+                self.logger.log_metrics(metrics, self.global_frame,
+                                        ty='train')
+        self.collect_eval(block=True)
+
+    def _train_loop(self):
+        # yields the steps to update the agent on, while the envs step
         # predicates
         train_until_step = utils.Until(self.cfg.num_train_frames,
                                        self.cfg.action_repeat)
@@ -148,76 +260,99 @@ class Workspace:
         eval_every_step = utils.Every(self.cfg.eval_every_frames,
                                       self.cfg.action_repeat)
 
-        episode_step, episode_reward = 0, 0
-        time_step = self.train_env.reset()
-        meta = self.agent.init_meta()
-        self.replay_storage.add(time_step, meta)
-        self.train_video_recorder.init(time_step.observation)
-        metrics = None
+        num_envs = len(self.train_env)
+        episode_step = np.zeros(num_envs, dtype=np.int64)
+        episode_reward = np.zeros(num_envs)
+        time_steps = self.train_env.reset()
+        metas = [self.agent.init_meta() for _ in range(num_envs)]
+        for env_id in range(num_envs):
+            self.replay_storage.add(time_steps[env_id], metas[env_id], env_id)
+        self.train_video_recorder.init(time_steps[0].observation)
+        updated = False
+        last_frame = self.global_frame
         while train_until_step(self.global_step):
-            if time_step.last():
+            finished = [i for i, ts in enumerate(time_steps) if ts.last()]
+            # wait until all the metrics schema is populated
+            if finished and updated:
+                elapsed_time, total_time = self.timer.reset()
+                fps = (self.global_frame - last_frame) / elapsed_time
+                last_frame = self.global_frame
+            for env_id in finished:
                 self._global_episode += 1
-                self.train_video_recorder.save(f'{self.global_frame}.mp4')
-                # wait until all the metrics schema is populated
-                if metrics is not None:
+                if env_id == 0:
+                    self.train_video_recorder.save(f'{self.global_frame}.mp4')
+                if updated:
                     # log stats
-                    elapsed_time, total_time = self.timer.reset()
-                    episode_frame = episode_step * self.cfg.action_repeat
+                    episode_frame = (episode_step[env_id] *
+                                     self.cfg.action_repeat)
                     with self.logger.log_and_dump_ctx(self.global_frame,
                                                       ty='train') as log:
-                        log('fps', episode_frame / elapsed_time)
+                        log('fps', fps)
                         log('total_time', total_time)
-                        log('episode_reward', episode_reward)
+                        log('episode_reward', episode_reward[env_id])
                         log('episode_length', episode_frame)
                         log('episode', self.global_episode)
                         log('buffer_size', len(self.replay_storage))
                         log('step', self.global_step)
 
                 # reset env
-                time_step = self.train_env.reset()
-                meta = self.agent.init_meta()
-                self.replay_storage.add(time_step, meta)
-                self.train_video_recorder.init(time_step.observation)
-
-                episode_step = 0
-                episode_reward = 0
-
+                time_steps[env_id] = self.train_env.reset(env_id)
+                metas[env_id] = self.agent.init_meta()
+                self.replay_storage.add(time_steps[env_id], metas[env_id],
+                                        env_id)
+                if env_id == 0:
+                    self.train_video_recorder.init(time_steps[0].observation)
+                episode_step[env_id] = 0
+                episode_reward[env_id] = 0
+
+            # each iteration takes num_envs env steps, starting at global_step
             # try to evaluate
-            if eval_every_step(self.global_step):
-                self.logger.log('eval_total_time', self.timer.total_time(),
-                                self.global_frame)
+            if eval_every_step(self.global_step, num_envs):
                 self.eval()
+            self.collect_eval()
 
-            meta = self.agent.update_meta(meta, self.global_step, time_step)
+            for env_id in range(num_envs):
+                metas[env_id] = self.agent.update_meta(
+                    metas[env_id], self.global_step + env_id,
+                    time_steps[env_id])
 
             if hasattr(self.agent, "regress_meta"):
                 repeat = self.cfg.action_repeat
-                every = self.agent.update_task_every_step // repeat
+                every = utils.Every(self.agent.update_task_every_step, repeat)
                 init_step = self.agent.num_init_steps
-                if self.global_step > (
-                        init_step // repeat) and self.global_step % every == 0:
+                if self.global_step > (init_step // repeat) and every(
+                        self.global_step, num_envs):
                     meta = self.agent.regress_meta(self.replay_iter,
                                                    self.global_step)
+                    metas = [meta] * num_envs
 
-            # sample action
+            # sample actions
+            obs = np.stack([time_step.observation for time_step in time_steps])
+            meta = {k: np.stack([m[k] for m in metas]) for k in metas[0]}
             with torch.no_grad(), utils.eval_mode(self.agent):
-                action = self.agent.act(time_step.observation,
-                                        meta,
-                                        self.global_step,
-                                        eval_mode=False)
-
-            # try to update the agent
-            if not seed_until_step(self.global_step):
-                metrics = self.agent.update(self.replay_iter, self.global_step)
-                self.logger.log_metrics(metrics, self.global_frame, ty='train')
-
-            # take env step
-            time_step = self.train_env.step(action)
-            episode_reward += time_step.reward
-            self.replay_storage.add(time_step, meta)
-            self.train_video_recorder.record(time_step.observation)
+                actions = self.agent.act(obs,
+                                         meta,
+                                         self.global_step,
+                                         eval_mode=False)
+            self.train_env.step_async(actions)
+
+            # try to update the agent, once per env step
+            steps = [
+                step
+                for step in range(self.global_step, self.global_step +
+                                  num_envs) if not seed_until_step(step)
+            ]
+            yield steps
+            updated = updated or bool(steps)
+
+            # take env steps
+            time_steps = self.train_env.step_wait()
+            for env_id, time_step in enumerate(time_steps):
+                episode_reward[env_id] += time_step.reward
+                self.replay_storage.add(time_step, metas[env_id], env_id)
+            self.train_video_recorder.record(time_steps[0].observation)
             episode_step += 1
-            self._global_step += 1
+            self._global_step += num_envs
 
     def load_snapshot(self):
         snapshot_base_dir = Path(self.cfg.snapshot_base_dir)
@@ -246,8 +381,29 @@ class Workspace:
         # return None
 
 
+def train_multi_seed(workspaces):
+    # one workspace per seed with the same ddpg config, they run in lockstep
+    # and all their agents get one stacked update per step
+    agent = MultiSeedDDPG([workspace.agent for workspace in workspaces])
+    loops = [workspace._train_loop() for workspace in workspaces]
+    for steps in zip(*loops):
+        for step in steps[0]:
+            with agent.amp.autocast():
+                metrics = agent.update(
+                    [workspace.replay_iter for workspace in workspaces], step)
+            for workspace, seed_metrics in zip(workspaces, metrics):
+                workspace.logger.log_metrics(seed_metrics,
+                                             workspace.global_frame,
+                                             ty='train')
+    for workspace in workspaces:
+        workspace.collect_eval(block=True)
+
+
 @hydra.main(config_path='.', config_name='finetune')
 def main(cfg):
+    if cfg.num_seeds > 1 and (cfg.use_wandb or cfg.prioritized_replay):
+        raise NotImplementedError(
+            'num_seeds > 1 does not support wandb or prioritized replay')
     if cfg.use_wandb:
         import omegaconf
         cfg.seed = cfg.pt_seed
@@ -267,6 +423,14 @@ def main(cfg):
 
     from finetune import Workspace as W
     root_dir = Path.cwd()
+    if cfg.num_seeds > 1:
+        workspaces = []
+        for seed in range(cfg.seed, cfg.seed + cfg.num_seeds):
+            seed_cfg = copy.deepcopy(cfg)
+            seed_cfg.seed = seed
+            workspaces.append(W(seed_cfg, root_dir / f'seed_{seed}'))
+        train_multi_seed(workspaces)
+        return
     workspace = W(cfg)
     snapshot = root_dir / 'snapshot.pt'
     print(snapshot)
@@ -26,11 +26,13 @@ class AverageMeter(object):
         self._count = 0
 
     def update(self, value, n=1):
+        # tensors are summed where they are, they are only read in value
         self._sum += value
         self._count += n
 
     def value(self):
-        return self._sum / max(1, self._count)
+        value = self._sum / max(1, self._count)
+        return value.item() if type(value) == torch.Tensor else value
 
 
 class MetersGroup(object):
@@ -45,15 +47,18 @@ class MetersGroup(object):
     def log(self, key, value, n=1):
         self._meters[key].update(value, n)
 
-    def _prime_meters(self):
+    def values(self):
+        return {key: meter.value() for key, meter in self._meters.items()}
+
+    def _prime_meters(self, values):
         data = dict()
-        for key, meter in self._meters.items():
+        for key, value in values.items():
             if key.startswith('train'):
                 key = key[len('train') + 1:]
             else:
                 key = key[len('eval') + 1:]
             key = key.replace('/', '_')
-            data[key] = meter.value()
+            data[key] = value
         return data
 
     def _remove_old_entries(self, data):
@@ -112,10 +117,10 @@ class MetersGroup(object):
     def _dump_to_wandb(self, data):
         wandb.log(data)
 
-    def dump(self, step, prefix):
+    def dump(self, step, prefix, values=None):
         if len(self._meters) == 0:
             return
-        data = self._prime_meters()
+        data = self._prime_meters(self.values() if values is None else values)
         data['frame'] = step
         if self.use_wandb:
             wandb_data = {prefix + '/' + key: val for key, val in data.items()}
@@ -139,6 +144,8 @@ class Logger(object):
         else:
             self._sw = None
         self.use_wandb = use_wandb
+        # tensor values go to tensorboard averaged, at dump
+        self._deferred_sw_keys = set()
 
     def _try_sw_log(self, key, value, step):
         if self._sw is not None:
@@ -147,8 +154,11 @@ class Logger(object):
     def log(self, key, value, step):
         assert key.startswith('train') or key.startswith('eval')
         if type(value) == torch.Tensor:
-            value = value.item()
-        self._try_sw_log(key, value, step)
+            # kept on the device until dump, logging doesn't sync
+            value = value.detach()
+            self._deferred_sw_keys.add(key)
+        else:
+            self._try_sw_log(key, value, step)
         mg = self._train_mg if key.startswith('train') else self._eval_mg
         mg.log(key, value)
 
@@ -156,11 +166,18 @@ class Logger(object):
         for key, value in metrics.items():
             self.log(f'{ty}/{key}', value, step)
 
+    def _dump(self, mg, step, ty):
+        values = mg.values()
+        for key in self._deferred_sw_keys.intersection(values):
+            self._try_sw_log(key, values[key], step)
+        self._deferred_sw_keys.difference_update(values)
+        mg.dump(step, ty, values)
+
     def dump(self, step, ty=None):
         if ty is None or ty == 'eval':
-            self._eval_mg.dump(step, 'eval')
+            self._dump(self._eval_mg, step, 'eval')
         if ty is None or ty == 'train':
-            self._train_mg.dump(step, 'train')
+            self._dump(self._train_mg, step, 'train')
 
     def log_and_dump_ctx(self, step, ty):
         return LogAndDumpCtx(self, step, ty)
@@ -8,9 +8,11 @@ os.environ['MKL_SERVICE_FORCE_INTEL'] = '1'
 os.environ['MUJOCO_GL'] = 'egl'
 
 from pathlib import Path
+from queue import Empty
 
 import hydra
 import numpy as np
+import omegaconf
 import torch
 import wandb
 from dm_env import specs
@@ -18,7 +20,7 @@ from dm_env import specs
 import dmc
 import utils
 from logger import Logger
-from replay_buffer import ReplayBufferStorage, make_replay_loader
+from replay_buffer import make_replay_loader, make_replay_storage
 from video import TrainVideoRecorder, VideoRecorder
 
 torch.backends.cudnn.benchmark = True
@@ -34,6 +36,100 @@ def make_agent(obs_type, obs_spec, action_spec, num_expl_steps, cfg):
     return hydra.utils.instantiate(cfg)
 
 
+def _cpu_cfg(cfg):
+    # plain copy of the config for child processes, with the agent on cpu
+    cfg = omegaconf.OmegaConf.create(
+        omegaconf.OmegaConf.to_container(cfg, resolve=True))
+    cfg.device = cfg.agent.device = 'cpu'
+    return cfg
+
+
+def _evaluate(agent, eval_env, meta, num_episodes, global_step, global_frame,
+              video_recorder):
+    # runs the episodes len(eval_env) at a time with one batched act call
+    # per step, the video follows the first env of the first round
+    step, episode, total_reward = 0, 0, 0
+    meta = {k: np.stack([v] * len(eval_env)) for k, v in meta.items()}
+    while episode < num_episodes:
+        num_active = min(len(eval_env), num_episodes - episode)
+        time_steps = eval_env.reset()
+        video_recorder.init(eval_env, enabled=(episode == 0))
+        done = np.arange(len(eval_env)) >= num_active
+        while not done.all():
+            obs = np.stack([time_step.observation for time_step in time_steps])
+            with torch.no_grad(), utils.eval_mode(agent):
+                actions = agent.act(obs, meta, global_step, eval_mode=True)
+            time_steps = eval_env.step(actions)
+            if not done[0]:
+                video_recorder.record(eval_env)
+            for env_id, time_step in enumerate(time_steps):
+                if not done[env_id]:
+                    total_reward += time_step.reward
+                    step += 1
+                    done[env_id] = time_step.last()
+
+        episode += num_active
+        video_recorder.save(f'{global_frame}.mp4')
+    return total_reward / episode, step / episode
+
+
+def _background_eval(cfg, params, meta, global_step, result_queue):
+    # runs in its own process on a cpu copy of the actor and encoder
+    torch.set_num_threads(1)
+    utils.set_seed_everywhere(cfg.seed)
+    eval_env = dmc.make_vector(PRIMAL_TASKS[cfg.domain], cfg.obs_type,
+                               cfg.frame_stack, cfg.action_repeat, cfg.seed,
+                               cfg.num_eval_envs)
+    agent = make_agent(cfg.obs_type, eval_env.observation_spec(),
+                       eval_env.action_spec(),
+                       cfg.num_seed_frames // cfg.action_repeat, cfg.agent)
+    agent.actor.load_state_dict(params['actor'])
+    agent.encoder.load_state_dict(params['encoder'])
+    result_queue.put(
+        _evaluate(agent, eval_env, meta, cfg.num_eval_episodes, global_step,
+                  global_step * cfg.action_repeat, VideoRecorder(None)))
+
+
+def _actor_loop(actor_id, cfg, params, version, lock, episode_queue, stop):
+    # runs in its own process, with a cpu copy of the agent whose actor and
+    # encoder are loaded from params whenever the learner bumps version
+    torch.set_num_threads(1)
+    utils.set_seed_everywhere(cfg.seed + actor_id)
+    env = dmc.make(PRIMAL_TASKS[cfg.domain], cfg.obs_type, cfg.frame_stack,
+                   cfg.action_repeat, cfg.seed + actor_id)
+    agent = make_agent(cfg.obs_type, env.observation_spec(),
+                       env.action_spec(),
+                       cfg.num_seed_frames // cfg.action_repeat, cfg.agent)
+    modules = dict(actor=agent.actor, encoder=agent.encoder)
+    local_version = -1
+    step = 0
+    while not stop.is_set():
+        time_step = env.reset()
+        meta = agent.init_meta()
+        episode = [(time_step, meta)]
+        versions = []
+        while not time_step.last() and not stop.is_set():
+            if version.value != local_version:
+                with lock:
+                    for name, module in modules.items():
+                        module.load_state_dict(params[name])
+                    local_version = version.value
+            # the actors take turns in the global step count
+            global_step = step * cfg.num_actors + actor_id
+            meta = agent.update_meta(meta, global_step, time_step)
+            with torch.no_grad(), utils.eval_mode(agent):
+                action = agent.act(time_step.observation,
+                                   meta,
+                                   global_step,
+                                   eval_mode=False)
+            time_step = env.step(action)
+            episode.append((time_step, meta))
+            versions.append(local_version)
+            step += 1
+        if time_step.last():
+            episode_queue.put((actor_id, episode, np.mean(versions)))
+
+
 class Workspace:
     def __init__(self, cfg):
         self.work_dir = Path.cwd()
@@ -56,10 +152,16 @@ class Workspace:
                              use_wandb=cfg.use_wandb)
         # create envs
         task = PRIMAL_TASKS[self.cfg.domain]
-        self.train_env = dmc.make(task, cfg.obs_type, cfg.frame_stack,
-                                  cfg.action_repeat, cfg.seed)
-        self.eval_env = dmc.make(task, cfg.obs_type, cfg.frame_stack,
-                                 cfg.action_repeat, cfg.seed)
+        self.train_env = dmc.make_vector(task, cfg.obs_type, cfg.frame_stack,
+                                         cfg.action_repeat, cfg.seed,
+                                         cfg.num_envs, cfg.async_envs)
+        if not cfg.background_eval:
+            self.eval_env = dmc.make_vector(task, cfg.obs_type,
+                                            cfg.frame_stack,
+                                            cfg.action_repeat, cfg.seed,
+                                            cfg.num_eval_envs,
+                                            cfg.async_envs)
+        self._eval_proc = None
 
         # create agent
         self.agent = make_agent(cfg.obs_type,
@@ -77,15 +179,23 @@ class Workspace:
                       specs.Array((1,), np.float32, 'discount'))
 
         # create data storage
-        self.replay_storage = ReplayBufferStorage(data_specs, meta_specs,
-                                                  self.work_dir / 'buffer')
+        frame_stack = cfg.frame_stack if (cfg.obs_type == 'pixels' and
+                                          cfg.replay_dedup_frames) else 1
+        self.replay_storage = make_replay_storage(cfg.replay_buffer_format,
+                                                  data_specs, meta_specs,
+                                                  self.work_dir / 'buffer',
+                                                  cfg.replay_buffer_size,
+                                                  cfg.device, frame_stack,
+                                                  cfg.replay_async_write)
 
         # create replay buffer
         self.replay_loader = make_replay_loader(self.replay_storage,
                                                 cfg.replay_buffer_size,
                                                 cfg.batch_size,
                                                 cfg.replay_buffer_num_workers,
-                                                False, cfg.nstep, cfg.discount)
+                                                False, cfg.nstep, cfg.discount,
+                                                cfg.prioritized_replay,
+                                                cfg.per_alpha, cfg.per_beta)
         self._replay_iter = None
 
         # create video recorders
@@ -121,31 +231,60 @@ class Workspace:
         return self._replay_iter
 
     def eval(self):
-        step, episode, total_reward = 0, 0, 0
-        eval_until_episode = utils.Until(self.cfg.num_eval_episodes)
         meta = self.agent.init_meta()
-        while eval_until_episode(episode):
-            time_step = self.eval_env.reset()
-            self.video_recorder.init(self.eval_env, enabled=(episode == 0))
-            while not time_step.last():
-                with torch.no_grad(), utils.eval_mode(self.agent):
-                    action = self.agent.act(time_step.observation,
-                                            meta,
+        eval_info = (self.global_step, self.global_episode,
+                     self.timer.total_time())
+        if not self.cfg.background_eval:
+            result = _evaluate(self.agent, self.eval_env, meta,
+                               self.cfg.num_eval_episodes, self.global_step,
+                               self.global_frame, self.video_recorder)
+            self._log_eval(result, *eval_info)
+            return
+
+        # one background eval at a time, it runs on the weights as they are
+        # now and is logged under this step once it finishes
+        self.collect_eval(block=True)
+        params = {
+            name: {
+                k: v.detach().cpu().clone()
+                for k, v in module.state_dict().items()
+            }
+            for name, module in dict(actor=self.agent.actor,
+                                     encoder=self.agent.encoder).items()
+        }
+        ctx = torch.multiprocessing.get_context('spawn')
+        self._eval_queue = ctx.Queue()
+        self._eval_proc = ctx.Process(target=_background_eval,
+                                      args=(_cpu_cfg(self.cfg), params, meta,
                                             self.global_step,
-                                            eval_mode=True)
-                time_step = self.eval_env.step(action)
-                self.video_recorder.record(self.eval_env)
-                total_reward += time_step.reward
-                step += 1
-
-            episode += 1
-            self.video_recorder.save(f'{self.global_frame}.mp4')
-
-        with self.logger.log_and_dump_ctx(self.global_frame, ty='eval') as log:
-            log('episode_reward', total_reward / episode)
-            log('episode_length', step * self.cfg.action_repeat / episode)
-            log('episode', self.global_episode)
-            log('step', self.global_step)
+                                            self._eval_queue),
+                                      daemon=True)
+        self._eval_proc.start()
+        self._eval_info = eval_info
+
+    def collect_eval(self, block=False):
+        # logs the background eval if it has finished
+        if self._eval_proc is None:
+            return
+        try:
+            result = self._eval_queue.get(block=block)
+        except Empty:
+            if self._eval_proc.is_alive():
+                return
+            raise RuntimeError('background eval exited without a result')
+        self._eval_proc.join()
+        self._eval_proc = None
+        self._log_eval(result, *self._eval_info)
+
+    def _log_eval(self, result, step, episode, total_time):
+        episode_reward, episode_length = result
+        frame = step * self.cfg.action_repeat
+        with self.logger.log_and_dump_ctx(frame, ty='eval') as log:
+            log('total_time', total_time)
+            log('episode_reward', episode_reward)
+            log('episode_length', episode_length * self.cfg.action_repeat)
+            log('episode', episode)
+            log('step', step)
 
     def train(self):
         # predicates
@@ -156,70 +295,210 @@ class Workspace:
         eval_every_step = utils.Every(self.cfg.eval_every_frames,
                                       self.cfg.action_repeat)
 
-        episode_step, episode_reward = 0, 0
-        time_step = self.train_env.reset()
-        meta = self.agent.init_meta()
-        self.replay_storage.add(time_step, meta)
-        self.train_video_recorder.init(time_step.observation)
+        num_envs = len(self.train_env)
+        episode_step = np.zeros(num_envs, dtype=np.int64)
+        episode_reward = np.zeros(num_envs)
+        time_steps = self.train_env.reset()
+        metas = [self.agent.init_meta() for _ in range(num_envs)]
+        for env_id in range(num_envs):
+            self.replay_storage.add(time_steps[env_id], metas[env_id], env_id)
+        self.train_video_recorder.init(time_steps[0].observation)
         metrics = None
+        last_frame = self.global_frame
         while train_until_step(self.global_step):
-            if time_step.last():
+            finished = [i for i, ts in enumerate(time_steps) if ts.last()]
+            # wait until all the metrics schema is populated
+            if finished and metrics is not None:
+                elapsed_time, total_time = self.timer.reset()
+                fps = (self.global_frame - last_frame) / elapsed_time
+                last_frame = self.global_frame
+            for env_id in finished:
                 self._global_episode += 1
-                self.train_video_recorder.save(f'{self.global_frame}.mp4')
-                # wait until all the metrics schema is populated
+                if env_id == 0:
+                    self.train_video_recorder.save(f'{self.global_frame}.mp4')
                 if metrics is not None:
                     # log stats
-                    elapsed_time, total_time = self.timer.reset()
-                    episode_frame = episode_step * self.cfg.action_repeat
+                    episode_frame = (episode_step[env_id] *
+                                     self.cfg.action_repeat)
                     with self.logger.log_and_dump_ctx(self.global_frame,
                                                       ty='train') as log:
-                        log('fps', episode_frame / elapsed_time)
+                        log('fps', fps)
                         log('total_time', total_time)
-                        log('episode_reward', episode_reward)
+                        log('episode_reward', episode_reward[env_id])
                         log('episode_length', episode_frame)
                         log('episode', self.global_episode)
                         log('buffer_size', len(self.replay_storage))
                         log('step', self.global_step)
 
                 # reset env
-                time_step = self.train_env.reset()
-                meta = self.agent.init_meta()
-                self.replay_storage.add(time_step, meta)
-                self.train_video_recorder.init(time_step.observation)
-                # try to save snapshot
-                if self.global_frame in self.cfg.snapshots:
-                    self.save_snapshot()
-                episode_step = 0
-                episode_reward = 0
-
+                time_steps[env_id] = self.train_env.reset(env_id)
+                metas[env_id] = self.agent.init_meta()
+                self.replay_storage.add(time_steps[env_id], metas[env_id],
+                                        env_id)
+                if env_id == 0:
+                    self.train_video_recorder.init(time_steps[0].observation)
+                episode_step[env_id] = 0
+                episode_reward[env_id] = 0
+
+            # each iteration takes num_envs env steps, starting at global_step
             # try to evaluate
-            if eval_every_step(self.global_step):
-                self.logger.log('eval_total_time', self.timer.total_time(),
-                                self.global_frame)
+            if eval_every_step(self.global_step, num_envs):
                 self.eval()
+            self.collect_eval()
+
+            for env_id in range(num_envs):
+                metas[env_id] = self.agent.update_meta(
+                    metas[env_id], self.global_step + env_id,
+                    time_steps[env_id])
 
-            meta = self.agent.update_meta(meta, self.global_step, time_step)
-            # sample action
+            # sample actions
+            obs = np.stack([time_step.observation for time_step in time_steps])
+            meta = {k: np.stack([m[k] for m in metas]) for k in metas[0]}
             with torch.no_grad(), utils.eval_mode(self.agent):
-                action = self.agent.act(time_step.observation,
-                                        meta,
-                                        self.global_step,
-                                        eval_mode=False)
-
-            # try to update the agent
-            if not seed_until_step(self.global_step):
-                metrics = self.agent.update(self.replay_iter, self.global_step)
+                actions = self.agent.act(obs,
+                                         meta,
+                                         self.global_step,
+                                         eval_mode=False)
+            self.train_env.step_async(actions)
+
+            # try to update the agent, once per env step
+            for step in range(self.global_step, self.global_step + num_envs):
+                if not seed_until_step(step):
+                    with self.agent.amp.autocast():
+                        metrics = self.agent.update(self.replay_iter, step)
+                    self.logger.log_metrics(metrics, self.global_frame,
+                                            ty='train')
+
+            # take env steps
+            time_steps = self.train_env.step_wait()
+            for env_id, time_step in enumerate(time_steps):
+                episode_reward[env_id] += time_step.reward
+                self.replay_storage.add(time_step, metas[env_id], env_id)
+            self.train_video_recorder.record(time_steps[0].observation)
+            episode_step += 1
+            self._global_step += num_envs
+
+            # try to save snapshot
+            frames = num_envs * self.cfg.action_repeat
+            if any(self.global_frame - frames < frame <= self.global_frame
+                   for frame in self.cfg.snapshots):
+                self.save_snapshot()
+        self.collect_eval(block=True)
+
+    def train_decoupled(self):
+        # actors collect episodes in their own processes, this process only
+        # stores them and learns
+        train_until_step = utils.Until(self.cfg.num_train_frames,
+                                       self.cfg.action_repeat)
+        seed_until_step = utils.Until(self.cfg.num_seed_frames,
+                                      self.cfg.action_repeat)
+        eval_every_step = utils.Every(self.cfg.eval_every_frames,
+                                      self.cfg.action_repeat)
+        seed_steps = self.cfg.num_seed_frames // self.cfg.action_repeat
+
+        cfg = _cpu_cfg(self.cfg)
+        modules = dict(actor=self.agent.actor, encoder=self.agent.encoder)
+        params = {
+            name: {
+                k: v.detach().cpu().clone().share_memory_()
+                for k, v in module.state_dict().items()
+            }
+            for name, module in modules.items()
+        }
+        ctx = torch.multiprocessing.get_context('spawn')
+        version = ctx.Value('l', 0)
+        lock = ctx.Lock()
+        # bounded, so the actors wait while the learner catches up
+        episode_queue = ctx.Queue(maxsize=cfg.num_actors)
+        stop = ctx.Event()
+        actors = [
+            ctx.Process(target=_actor_loop,
+                        args=(actor_id, cfg, params, version, lock,
+                              episode_queue, stop),
+                        daemon=True) for actor_id in range(cfg.num_actors)
+        ]
+        for actor in actors:
+            actor.start()
+
+        def publish():
+            with lock:
+                for name, module in modules.items():
+                    for k, v in module.state_dict().items():
+                        params[name][k].copy_(v)
+                version.value += 1
+
+        num_updates = 0
+        metrics = None
+        last_frame = self.global_frame
+        while train_until_step(self.global_step):
+            # keep to update_to_data_ratio agent.update calls per env step
+            # collected after the seed frames
+            if not seed_until_step(self.global_step) and (
+                    num_updates < self.cfg.update_to_data_ratio *
+                (self.global_step - seed_steps)):
+                with self.agent.amp.autocast():
+                    metrics = self.agent.update(self.replay_iter,
+                                                seed_steps + num_updates)
                 self.logger.log_metrics(metrics, self.global_frame, ty='train')
+                num_updates += 1
+                if num_updates % self.cfg.actor_sync_every == 0:
+                    publish()
+                continue
+
+            # caught up, store the next episodes
+            episodes = [episode_queue.get()]
+            while True:
+                try:
+                    episodes.append(episode_queue.get_nowait())
+                except Empty:
+                    break
+
+            for actor_id, episode, episode_version in episodes:
+                start_step = self.global_step
+                for time_step, meta in episode:
+                    self.replay_storage.add(time_step, meta, actor_id)
+                episode_step = len(episode) - 1
+                self._global_step += episode_step
+                self._global_episode += 1
+                if metrics is not None:
+                    elapsed_time, total_time = self.timer.reset()
+                    episode_frame = episode_step * self.cfg.action_repeat
+                    episode_reward = sum(ts.reward for ts, _ in episode[1:])
+                    with self.logger.log_and_dump_ctx(self.global_frame,
+                                                      ty='train') as log:
+                        log('fps',
+                            (self.global_frame - last_frame) / elapsed_time)
+                        log('total_time', total_time)
+                        log('episode_reward', episode_reward)
+                        log('episode_length', episode_frame)
+                        log('episode', self.global_episode)
+                        log('buffer_size', len(self.replay_storage))
+                        log('step', self.global_step)
+                        log('staleness', version.value - episode_version)
+                    last_frame = self.global_frame
 
-            # take env step
-            time_step = self.train_env.step(action)
-            episode_reward += time_step.reward
-            self.replay_storage.add(time_step, meta)
-            self.train_video_recorder.record(time_step.observation)
-            episode_step += 1
-            self._global_step += 1
+                # try to evaluate
+                if eval_every_step(start_step, episode_step):
+                    self.eval()
+
+                # try to save snapshot
+                if any(start_step * self.cfg.action_repeat < frame <=
+                       self.global_frame for frame in self.cfg.snapshots):
+                    self.save_snapshot()
+            self.collect_eval()
+
+        stop.set()
+        while any(actor.is_alive() for actor in actors):
+            try:
+                episode_queue.get(timeout=1)
+            except Empty:
+                pass
+        for actor in actors:
+            actor.join()
+        self.collect_eval(block=True)
 
     def save_snapshot(self):
+        self.replay_storage.flush()
         import torch.nn.utils.parametrize as parametrize
         for c in self.agent.modules():
             try: parametrize.remove_parametrizations(c, 'weight')
@@ -257,7 +536,10 @@ def main(cfg):
     if snapshot.exists():
         print(f'resuming: {snapshot}')
         workspace.load_snapshot()
-    workspace.train()
+    if cfg.decoupled:
+        workspace.train_decoupled()
+    else:
+        workspace.train()
 
 
 if __name__ == '__main__':
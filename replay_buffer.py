@@ -1,8 +1,13 @@
+import atexit
+import copy
 import datetime
 import io
+import queue
 import random
+import threading
 import traceback
-from collections import defaultdict
+from itertools import chain
+from multiprocessing import shared_memory
 
 import numpy as np
 import torch
@@ -30,45 +35,179 @@ def load_episode(fn):
         return episode
 
 
+def nstep_return(reward, discount, gamma):
+    """n-step discounted reward and bootstrap discount from per step windows
+    of shape (batch, nstep, 1)"""
+    discounts = np.cumprod(discount * gamma, axis=1)
+    # discount accumulated before each step of the window
+    prev_discounts = np.concatenate(
+        [np.ones_like(discounts[:, :1]), discounts[:, :-1]], axis=1)
+    return (prev_discounts * reward).sum(axis=1), discounts[:, -1]
+
+
+class EpisodeIndex:
+    """append-only log of stored episodes, one whitespace separated record
+    per line"""
+    def __init__(self, path):
+        self._path = path
+        self._pos = 0
+
+    def reset(self):
+        self._path.write_bytes(b'')
+
+    def append(self, *record):
+        line = ' '.join(str(x) for x in record) + '\n'
+        with self._path.open('ab') as f:
+            f.write(line.encode())
+
+    def read_new(self):
+        # only return complete records appended since the last call
+        if not self._path.exists():
+            return []
+        with self._path.open('rb') as f:
+            f.seek(self._pos)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        self._pos += end
+        return [line.split() for line in data[:end].decode().splitlines()]
+
+
 class ReplayBufferStorage:
-    def __init__(self, data_specs, meta_specs, replay_dir):
+    def __init__(self,
+                 data_specs,
+                 meta_specs,
+                 replay_dir,
+                 frame_stack=1,
+                 async_write=False,
+                 max_pending=8,
+                 episode_capacity=1024):
+        # with frame_stack > 1 only the newest frame of each stacked pixel
+        # observation is stored and the buffers rebuild the stacks
+        self._frame_stack = frame_stack
+        if frame_stack > 1:
+            data_specs = tuple(
+                spec.replace(shape=(spec.shape[0] // frame_stack,
+                                    *spec.shape[1:]))
+                if spec.name == 'observation' else spec
+                for spec in data_specs)
         self._data_specs = data_specs
         self._meta_specs = meta_specs
         self._replay_dir = replay_dir
         replay_dir.mkdir(exist_ok=True)
-        self._current_episode = defaultdict(list)
+        # steps are written in place into preallocated per-episode arrays,
+        # that double in size whenever an episode outgrows them. episodes
+        # from several environments can be in progress, keyed by env_id
+        self._episode_capacity = episode_capacity
+        self._current_episodes = dict()
+        self._episode_steps = dict()
         self._preload()
+        # finished episodes are handed to a writer thread so that add never
+        # blocks on converting and saving them
+        self._queue = None
+        self._writer = None
+        self._writer_error = None
+        if async_write:
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._writer = threading.Thread(target=self._write_loop,
+                                            daemon=True)
+            self._writer.start()
+            atexit.register(self.flush)
+
+    def __getstate__(self):
+        # the writer stays with the process that adds the episodes
+        state = self.__dict__.copy()
+        state['_queue'] = None
+        state['_writer'] = None
+        state['_current_episodes'] = dict()
+        state['_episode_steps'] = dict()
+        return state
 
     def __len__(self):
         return self._num_transitions
 
-    def add(self, time_step, meta):
-        for key, value in meta.items():
-            self._current_episode[key].append(value)
+    def add(self, time_step, meta, env_id=0):
+        if env_id not in self._current_episodes:
+            self._new_episode(env_id)
+        current_episode = self._current_episodes[env_id]
+        step = self._episode_steps[env_id]
+        if step == len(next(iter(current_episode.values()))):
+            current_episode = self._grow_episode(env_id)
+        for spec in self._meta_specs:
+            current_episode[spec.name][step] = meta[spec.name]
         for spec in self._data_specs:
             value = time_step[spec.name]
-            if np.isscalar(value):
-                value = np.full(spec.shape, value, spec.dtype)
-            assert spec.shape == value.shape and spec.dtype == value.dtype
-            self._current_episode[spec.name].append(value)
+            if spec.name == 'observation' and self._frame_stack > 1:
+                value = value[-spec.shape[0]:]
+            if step == 0 and not np.isscalar(value):
+                assert spec.shape == value.shape and spec.dtype == value.dtype
+            current_episode[spec.name][step] = value
+        self._episode_steps[env_id] = step + 1
         if time_step.last():
-            episode = dict()
-            for spec in self._data_specs:
-                value = self._current_episode[spec.name]
-                episode[spec.name] = np.array(value, spec.dtype)
-            for spec in self._meta_specs:
-                value = self._current_episode[spec.name]
-                episode[spec.name] = np.array(value, spec.dtype)
-            self._current_episode = defaultdict(list)
-            self._store_episode(episode)
+            episode = {
+                name: value[:step + 1]
+                for name, value in current_episode.items()
+            }
+            del self._current_episodes[env_id]
+            if self._queue is None:
+                self._store_episode(episode)
+            else:
+                self._check_writer()
+                self._queue.put(episode)
+
+    def _new_episode(self, env_id):
+        # fresh arrays for every episode, the previous ones may still be
+        # waiting in the writer queue
+        current_episode = dict()
+        for spec in chain(self._data_specs, self._meta_specs):
+            current_episode[spec.name] = np.empty(
+                (self._episode_capacity, *spec.shape), spec.dtype)
+        self._current_episodes[env_id] = current_episode
+        self._episode_steps[env_id] = 0
+
+    def _grow_episode(self, env_id):
+        current_episode = self._current_episodes[env_id]
+        size = 2 * next(iter(current_episode.values())).shape[0]
+        self._episode_capacity = max(self._episode_capacity, size)
+        for name, value in current_episode.items():
+            grown = np.empty((size, *value.shape[1:]), value.dtype)
+            grown[:value.shape[0]] = value
+            current_episode[name] = grown
+        return current_episode
+
+    def _write_loop(self):
+        while True:
+            episode = self._queue.get()
+            try:
+                self._store_episode(episode)
+            except Exception as e:
+                self._writer_error = e
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def _check_writer(self):
+        if self._writer_error is not None:
+            raise RuntimeError('episode writer failed') from self._writer_error
+
+    def flush(self):
+        # wait until every finished episode has been stored
+        if self._queue is not None:
+            self._queue.join()
+            self._check_writer()
 
     def _preload(self):
         self._num_episodes = 0
         self._num_transitions = 0
-        for fn in self._replay_dir.glob('*.npz'):
-            _, _, eps_len = fn.stem.split('_')
+        self._index = EpisodeIndex(self._replay_dir / 'index.txt')
+        self._index.reset()
+        # episodes left over from a previous run are listed in the new index
+        eps_fns = sorted(self._replay_dir.glob('*.npz'),
+                         key=lambda fn: int(fn.stem.split('_')[1]))
+        for fn in eps_fns:
+            _, eps_idx, eps_len = fn.stem.split('_')
             self._num_episodes += 1
             self._num_transitions += int(eps_len)
+            self._index.append(eps_idx, eps_len, fn.name)
 
     def _store_episode(self, episode):
         eps_idx = self._num_episodes
@@ -78,12 +217,260 @@ class ReplayBufferStorage:
         ts = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
         eps_fn = f'{ts}_{eps_idx}_{eps_len}.npz'
         save_episode(episode, self._replay_dir / eps_fn)
+        self._index.append(eps_idx, eps_len, eps_fn)
+
+
+class SharedEpisodeIndex:
+    """same interface as EpisodeIndex, but the records live in a ring of
+    shared memory with a counter of the number of records ever written"""
+    def __init__(self, max_records, name=None):
+        self._max_records = max_records
+        size = (max_records + 1) * 3 * np.dtype(np.int64).itemsize
+        self._shm = shared_memory.SharedMemory(name=name,
+                                               create=name is None,
+                                               size=size)
+        self._records = np.ndarray((max_records + 1, 3),
+                                   dtype=np.int64,
+                                   buffer=self._shm.buf)
+        self._pos = 0
+
+    def __getstate__(self):
+        return self._max_records, self._shm.name, self._pos
+
+    def __setstate__(self, state):
+        max_records, name, pos = state
+        self.__init__(max_records, name)
+        self._pos = pos
+
+    def reset(self):
+        self._records[:] = 0
+
+    def append(self, *record):
+        # the first row holds the counter, publish it after the record
+        count = self._records[0, 0]
+        self._records[1 + count % self._max_records] = record
+        self._records[0, 0] = count + 1
+
+    def read_new(self):
+        count = int(self._records[0, 0])
+        # records older than the ring have been overwritten already
+        start = max(self._pos, count - self._max_records)
+        self._pos = count
+        return [
+            self._records[1 + i % self._max_records].tolist()
+            for i in range(start, count)
+        ]
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+class RingReplayBufferStorage(ReplayBufferStorage):
+    """stores episodes uncompressed and contiguously in preallocated per-key
+    arrays used as a ring, and publishes (eps_idx, offset, eps_len) records
+    through an index that the loader workers read to locate the episodes"""
+    def __init__(self,
+                 data_specs,
+                 meta_specs,
+                 replay_dir,
+                 max_size,
+                 frame_stack=1,
+                 async_write=False):
+        # headroom so that episodes the loader workers may still be sampling
+        # are not overwritten before they see the newer index records
+        self._capacity = max_size + max_size // 10
+        super().__init__(data_specs, meta_specs, replay_dir, frame_stack,
+                         async_write)
+
+    def _alloc(self, spec):
+        raise NotImplementedError
+
+    def _make_index(self):
+        raise NotImplementedError
+
+    def _open_arrays(self):
+        raise NotImplementedError
+
+    def _preload(self):
+        self._num_episodes = 0
+        self._num_transitions = 0
+        self._cursor = 0
+        self._arrays = dict()
+        for spec in chain(self._data_specs, self._meta_specs):
+            self._arrays[spec.name] = self._alloc(spec)
+        self._index = self._make_index()
+        self._index.reset()
+
+    def _store_episode(self, episode):
+        eps_idx = self._num_episodes
+        eps_len = episode_len(episode)
+        assert eps_len + 1 <= self._capacity
+        if self._cursor + eps_len + 1 > self._capacity:
+            self._cursor = 0
+        offset = self._cursor
+        for name, value in episode.items():
+            self._arrays[name][offset:offset + eps_len + 1] = value
+        self._cursor += eps_len + 1
+        self._num_episodes += 1
+        self._num_transitions += eps_len
+        self._index.append(eps_idx, offset, eps_len)
+
+
+class MemmapReplayBufferStorage(RingReplayBufferStorage):
+    """ring storage backed by memory-mapped .npy files, one per key"""
+    def _alloc(self, spec):
+        return np.lib.format.open_memmap(self._replay_dir / f'{spec.name}.npy',
+                                         mode='w+',
+                                         dtype=spec.dtype,
+                                         shape=(self._capacity, *spec.shape))
+
+    def _make_index(self):
+        return EpisodeIndex(self._replay_dir / 'index.txt')
+
+    def _open_arrays(self):
+        # each worker maps the files itself, read-only
+        arrays = dict()
+        for spec in chain(self._data_specs, self._meta_specs):
+            arrays[spec.name] = np.load(self._replay_dir / f'{spec.name}.npy',
+                                        mmap_mode='r')
+        return arrays
+
+
+class SharedReplayBufferStorage(RingReplayBufferStorage):
+    """ring storage backed by shared memory blocks, one per key, so there is
+    a single in-memory copy of the data no matter how many workers read it"""
+    def __init__(self,
+                 data_specs,
+                 meta_specs,
+                 replay_dir,
+                 max_size,
+                 frame_stack=1,
+                 async_write=False):
+        self._shms = dict()
+        super().__init__(data_specs, meta_specs, replay_dir, max_size,
+                         frame_stack, async_write)
+        atexit.register(self.close)
+
+    def _alloc(self, spec, name=None):
+        shape = (self._capacity, *spec.shape)
+        size = max(1, int(np.prod(shape)) * np.dtype(spec.dtype).itemsize)
+        shm = shared_memory.SharedMemory(name=name,
+                                         create=name is None,
+                                         size=size)
+        self._shms[spec.name] = shm
+        return np.ndarray(shape, dtype=spec.dtype, buffer=shm.buf)
+
+    def _make_index(self):
+        # every episode spans at least two rows
+        return SharedEpisodeIndex(self._capacity // 2 + 1)
+
+    def _open_arrays(self):
+        return self._arrays
+
+    def __getstate__(self):
+        # workers started with spawn attach to the blocks by name
+        state = super().__getstate__()
+        state['_arrays'] = None
+        state['_shms'] = {k: v.name for k, v in self._shms.items()}
+        return state
+
+    def __setstate__(self, state):
+        names = state.pop('_shms')
+        self.__dict__.update(state)
+        self._shms = dict()
+        self._arrays = dict()
+        for spec in chain(self._data_specs, self._meta_specs):
+            self._arrays[spec.name] = self._alloc(spec, names[spec.name])
+
+    def close(self):
+        if not self._shms:
+            return
+        self.flush()
+        for shm in self._shms.values():
+            shm.unlink()
+        self._index.unlink()
+        self._shms = dict()
+
+
+class DeviceReplayBufferStorage(ReplayBufferStorage):
+    """keeps episodes contiguously in preallocated tensors on the training
+    device, to be sampled in-process by DeviceReplayBuffer"""
+    def __init__(self,
+                 data_specs,
+                 meta_specs,
+                 replay_dir,
+                 max_size,
+                 device,
+                 frame_stack=1):
+        self._capacity = max_size
+        self._device = torch.device(device)
+        super().__init__(data_specs, meta_specs, replay_dir, frame_stack)
+
+    def _preload(self):
+        self._num_episodes = 0
+        self._num_transitions = 0
+        self._cursor = 0
+        self._tensors = dict()
+        for spec in chain(self._data_specs, self._meta_specs):
+            dtype = torch.from_numpy(np.empty(0, spec.dtype)).dtype
+            self._tensors[spec.name] = torch.empty(
+                (self._capacity, *spec.shape), dtype=dtype, device=self._device)
+        # (offset, eps_len) of the episodes currently in the ring, oldest first
+        self._episodes = []
+        self._offsets = torch.empty(0, dtype=torch.long, device=self._device)
+        self._lengths = torch.empty(0, dtype=torch.long, device=self._device)
+
+    def _store_episode(self, episode):
+        eps_len = episode_len(episode)
+        assert eps_len + 1 <= self._capacity
+        if self._cursor + eps_len + 1 > self._capacity:
+            self._cursor = 0
+        offset, end = self._cursor, self._cursor + eps_len + 1
+        for name, value in episode.items():
+            self._tensors[name][offset:end] = torch.as_tensor(
+                value, device=self._device)
+        self._cursor = end
+        self._num_episodes += 1
+        self._num_transitions += eps_len
+        # drop the episodes that have just been overwritten
+        self._episodes = [(o, l) for o, l in self._episodes
+                          if o + l + 1 <= offset or end <= o]
+        self._episodes.append((offset, eps_len))
+        self._offsets = torch.tensor([o for o, _ in self._episodes],
+                                     device=self._device)
+        self._lengths = torch.tensor([l for _, l in self._episodes],
+                                     device=self._device)
+
+
+def make_replay_storage(replay_format,
+                        data_specs,
+                        meta_specs,
+                        replay_dir,
+                        max_size,
+                        device,
+                        frame_stack=1,
+                        async_write=False):
+    if replay_format == 'npz':
+        return ReplayBufferStorage(data_specs, meta_specs, replay_dir,
+                                   frame_stack, async_write)
+    elif replay_format == 'memmap':
+        return MemmapReplayBufferStorage(data_specs, meta_specs, replay_dir,
+                                         max_size, frame_stack, async_write)
+    elif replay_format == 'shared':
+        return SharedReplayBufferStorage(data_specs, meta_specs, replay_dir,
+                                         max_size, frame_stack, async_write)
+    elif replay_format == 'device':
+        # sampled in-process, so episodes are always stored synchronously
+        return DeviceReplayBufferStorage(data_specs, meta_specs, replay_dir,
+                                         max_size, device, frame_stack)
+    raise NotImplementedError(replay_format)
 
 
 class ReplayBuffer(IterableDataset):
-    def __init__(self, storage, max_size, num_workers, nstep, discount,
-                 fetch_every, save_snapshot):
+    def __init__(self, storage, max_size, num_workers, batch_size, nstep,
+                 discount, fetch_every, save_snapshot):
         self._storage = storage
+        self._batch_size = batch_size
         self._size = 0
         self._max_size = max_size
         self._num_workers = max(1, num_workers)
@@ -94,10 +481,11 @@ class ReplayBuffer(IterableDataset):
         self._fetch_every = fetch_every
         self._samples_since_last_fetch = fetch_every
         self._save_snapshot = save_snapshot
+        self._index = None
 
-    def _sample_episode(self):
-        eps_fn = random.choice(self._episode_fns)
-        return self._episodes[eps_fn]
+    def _open(self):
+        # opened lazily, once inside each worker
+        self._index = copy.copy(self._storage._index)
 
     def _store_episode(self, eps_fn):
         try:
@@ -111,7 +499,6 @@ class ReplayBuffer(IterableDataset):
             self._size -= episode_len(early_eps)
             early_eps_fn.unlink(missing_ok=True)
         self._episode_fns.append(eps_fn)
-        self._episode_fns.sort()
         self._episodes[eps_fn] = episode
         self._size += eps_len
 
@@ -127,41 +514,317 @@ class ReplayBuffer(IterableDataset):
             worker_id = torch.utils.data.get_worker_info().id
         except:
             worker_id = 0
-        eps_fns = sorted(self._storage._replay_dir.glob('*.npz'), reverse=True)
+        if self._index is None:
+            self._open()
+        # only the records appended since the last fetch, oldest first
+        eps_fns = []
         fetched_size = 0
-        for eps_fn in eps_fns:
-            eps_idx, eps_len = [int(x) for x in eps_fn.stem.split('_')[1:]]
+        for eps_idx, eps_len, eps_fn in reversed(self._index.read_new()):
+            eps_idx, eps_len = int(eps_idx), int(eps_len)
             if eps_idx % self._num_workers != worker_id:
                 continue
-            if eps_fn in self._episodes.keys():
-                break
             if fetched_size + eps_len > self._max_size:
                 break
             fetched_size += eps_len
-            if not self._store_episode(eps_fn):
-                break
+            eps_fns.append(self._storage._replay_dir / eps_fn)
+        for eps_fn in reversed(eps_fns):
+            self._store_episode(eps_fn)
+
+    def _take_obs(self, take, idx, start):
+        frame_stack = self._storage._frame_stack
+        if frame_stack == 1:
+            return take('observation', idx)
+        # rebuild the stacks, the first frame of the episode is repeated as
+        # in FrameStackWrapper.reset
+        steps = idx[:, None] + np.arange(1 - frame_stack, 1)
+        frames = take('observation', np.maximum(steps, start[:, None]))
+        return frames.reshape(frames.shape[0], -1, *frames.shape[3:])
+
+    def _make_batch(self, take, idx, start):
+        # take(name, idx) gathers the rows of a key for an array of indices,
+        # start holds the first row of the episode of each sample
+        meta = []
+        for spec in self._storage._meta_specs:
+            meta.append(take(spec.name, idx - 1))
+        obs = self._take_obs(take, idx - 1, start)
+        action = take('action', idx)
+        next_obs = self._take_obs(take, idx + self._nstep - 1, start)
+        steps = idx[:, None] + np.arange(self._nstep)
+        reward, discount = nstep_return(take('reward', steps),
+                                        take('discount', steps),
+                                        self._discount)
+        return (obs, action, reward, discount, next_obs, *meta)
+
+    def _sample(self):
+        try:
+            self._try_fetch()
+        except:
+            traceback.print_exc()
+        self._samples_since_last_fetch += self._batch_size
+        eps_ids = np.random.randint(len(self._episode_fns),
+                                    size=self._batch_size)
+        episodes = [self._episodes[self._episode_fns[i]] for i in eps_ids]
+        eps_lens = np.array([episode_len(episode) for episode in episodes])
+        # add +1 for the first dummy transition
+        idx = np.random.randint(0, eps_lens - self._nstep + 1) + 1
+
+        def take(name, idx):
+            return np.stack(
+                [episode[name][i] for episode, i in zip(episodes, idx)])
+
+        return self._make_batch(take, idx, np.zeros_like(idx))
+
+    def __iter__(self):
+        while True:
+            yield self._sample()
+
+
+class RingReplayBuffer(ReplayBuffer):
+    """samples from a RingReplayBufferStorage, episodes are views into the
+    storage arrays so every worker sees the whole buffer without holding a
+    private copy"""
+    def __init__(self, storage, max_size, num_workers, batch_size, nstep,
+                 discount, fetch_every):
+        super().__init__(storage, max_size, num_workers, batch_size, nstep,
+                         discount, fetch_every, save_snapshot=True)
+        self._arrays = None
+        self._offsets = dict()
+        self._bounds = None
+
+    def _open(self):
+        super()._open()
+        self._arrays = self._storage._open_arrays()
+
+    def _evict(self, eps_idx):
+        self._episode_fns.remove(eps_idx)
+        early_eps = self._episodes.pop(eps_idx)
+        self._offsets.pop(eps_idx)
+        self._size -= episode_len(early_eps)
+
+    def _store_episode(self, eps_idx, offset, eps_len):
+        end = offset + eps_len + 1
+        # drop episodes whose rows are being overwritten by the new one
+        for early_idx, (early_offset, early_end) in list(self._offsets.items()):
+            if early_offset < end and offset < early_end:
+                self._evict(early_idx)
+        while eps_len + self._size > self._max_size:
+            self._evict(self._episode_fns[0])
+        episode = {k: v[offset:end] for k, v in self._arrays.items()}
+        self._episode_fns.append(eps_idx)
+        self._episodes[eps_idx] = episode
+        self._offsets[eps_idx] = (offset, end)
+        self._size += eps_len
+
+    def _try_fetch(self):
+        if self._samples_since_last_fetch < self._fetch_every:
+            return
+        self._samples_since_last_fetch = 0
+        if self._arrays is None:
+            self._open()
+        records = self._index.read_new()
+        for record in records:
+            self._store_episode(*[int(x) for x in record])
+        if records:
+            self._bounds = np.array(
+                [self._offsets[eps_idx] for eps_idx in self._episode_fns])
 
     def _sample(self):
         try:
             self._try_fetch()
         except:
             traceback.print_exc()
-        self._samples_since_last_fetch += 1
-        episode = self._sample_episode()
+        self._samples_since_last_fetch += self._batch_size
+        eps_ids = np.random.randint(len(self._episode_fns),
+                                    size=self._batch_size)
+        offsets, ends = self._bounds[eps_ids].T
+        # add +1 for the first dummy transition
+        idx = np.random.randint(0, ends - offsets - self._nstep) + 1
+
+        def take(name, idx):
+            return self._arrays[name][idx]
+
+        return self._make_batch(take, offsets + idx, offsets)
+
+
+class SumTree:
+    """array-based binary sum tree over a fixed number of leaves, sampling
+    and updating a batch of leaves costs O(B log N) vectorized ops"""
+    def __init__(self, capacity, device):
+        self._depth = max(1, int(np.ceil(np.log2(capacity))))
+        self._leaves = 2**self._depth
+        # node i has children 2i and 2i+1, the root is node 1 and the leaves
+        # start at self._leaves
+        self._tree = torch.zeros(2 * self._leaves,
+                                 dtype=torch.float64,
+                                 device=device)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    @property
+    def leaves(self):
+        return self._tree[self._leaves:]
+
+    def rebuild(self):
+        level = self._leaves
+        while level > 1:
+            self._tree[level // 2:level] = self._tree[level:2 * level].view(
+                -1, 2).sum(dim=1)
+            level //= 2
+
+    def update(self, idx, priority):
+        node = idx + self._leaves
+        self._tree[node] = priority.to(self._tree.dtype)
+        for _ in range(self._depth):
+            # duplicated nodes are all assigned the same sum
+            node = node // 2
+            self._tree[node] = self._tree[2 * node] + self._tree[2 * node + 1]
+
+    def find(self, value):
+        # index of the leaf whose cumulative priority range contains value
+        node = torch.ones_like(value, dtype=torch.long)
+        for _ in range(self._depth):
+            left = self._tree[2 * node]
+            right = value >= left
+            value = torch.where(right, value - left, value)
+            node = 2 * node + right.long()
+        return node - self._leaves
+
+
+class PrioritizedBatch(tuple):
+    """a batch that also carries the sampled rows, their importance sampling
+    weights and a hook to update their priorities"""
+    def __new__(cls, batch, replay, indices, weights):
+        self = super().__new__(cls, batch)
+        self._replay = replay
+        self.indices = indices
+        self.weights = weights
+        return self
+
+    def update_priorities(self, priorities):
+        self._replay.update_priorities(self.indices, priorities)
+
+
+class DeviceReplayBuffer:
+    """samples whole batches from a DeviceReplayBufferStorage with vectorized
+    gathers, without going through a DataLoader. with prioritized=True rows
+    are drawn from a sum tree in proportion to their priority"""
+    def __init__(self,
+                 storage,
+                 batch_size,
+                 nstep,
+                 discount,
+                 prioritized=False,
+                 alpha=0.6,
+                 beta=0.4,
+                 eps=1e-6):
+        self._storage = storage
+        self._batch_size = batch_size
+        self._nstep = nstep
+        self._discount = discount
+        self._tree = None
+        if prioritized:
+            device = storage._device
+            self._alpha = alpha
+            self._beta = beta
+            self._eps = eps
+            self._tree = SumTree(storage._capacity, device)
+            self._max_priority = torch.ones((),
+                                           dtype=torch.float64,
+                                           device=device)
+            # rows that can be sampled and the first row of their episode
+            self._valid = np.zeros(storage._capacity, dtype=bool)
+            self._valid_mask = torch.zeros(storage._capacity, device=device)
+            self._starts = torch.zeros(storage._capacity,
+                                       dtype=torch.long,
+                                       device=device)
+            self._num_valid = 0
+            self._num_episodes = 0
+
+    def _take_obs(self, idx, start):
+        frames = self._storage._tensors['observation']
+        frame_stack = self._storage._frame_stack
+        if frame_stack == 1:
+            return frames[idx]
+        # rebuild the stacks, the first frame of the episode is repeated as
+        # in FrameStackWrapper.reset
+        steps = idx[:, None] + torch.arange(
+            1 - frame_stack, 1, device=idx.device)
+        steps = torch.maximum(steps, start[:, None])
+        return frames[steps].flatten(1, 2)
+
+    def _sync(self):
+        # give the episodes stored since the last call the max priority and
+        # zero the rows of the ones that have been dropped
+        storage = self._storage
+        num_new = storage._num_episodes - self._num_episodes
+        if num_new == 0:
+            return
+        self._num_episodes = storage._num_episodes
+        leaves = self._tree.leaves
+        self._valid[:] = False
+        for offset, eps_len in storage._episodes:
+            # add +1 for the first dummy transition
+            self._valid[offset + 1:offset + eps_len - self._nstep + 2] = True
+        self._valid_mask.copy_(torch.from_numpy(self._valid))
+        self._num_valid = int(self._valid.sum())
+        for offset, eps_len in storage._episodes[-num_new:]:
+            leaves[offset:offset + eps_len + 1] = self._max_priority
+            self._starts[offset:offset + eps_len + 1] = offset
+        leaves[:storage._capacity] *= self._valid_mask
+        self._tree.rebuild()
+
+    def update_priorities(self, indices, priorities):
+        priorities = priorities.detach().flatten().to(self._tree.total.dtype)
+        priorities = (priorities.abs() + self._eps)**self._alpha
+        self._max_priority = torch.maximum(self._max_priority,
+                                           priorities.max())
+        # rows dropped since they were sampled stay at zero
+        self._tree.update(indices, priorities * self._valid_mask[indices])
+
+    def _sample(self):
+        storage = self._storage
+        device = storage._device
+        if self._tree is not None:
+            self._sync()
+            # stratified over the total priority
+            value = torch.arange(self._batch_size, device=device) + torch.rand(
+                self._batch_size, device=device, dtype=torch.float64)
+            value = value * (self._tree.total / self._batch_size)
+            idx = self._tree.find(value).clamp_(max=storage._capacity - 1)
+            prob = self._tree.leaves[idx] / self._tree.total
+            weights = (self._num_valid * prob)**-self._beta
+            weights = (weights / weights.max()).float()[:, None]
+            batch = self._gather(idx, self._starts[idx])
+            return PrioritizedBatch(batch, self, idx, weights)
+        eps = torch.randint(len(storage._episodes), (self._batch_size,),
+                            device=device)
+        offsets, lengths = storage._offsets[eps], storage._lengths[eps]
         # add +1 for the first dummy transition
-        idx = np.random.randint(0, episode_len(episode) - self._nstep + 1) + 1
+        idx = (torch.rand(self._batch_size, device=device) *
+               (lengths - self._nstep + 1)).long() + 1
+        return self._gather(offsets + idx, offsets)
+
+    def _gather(self, idx, offsets):
+        storage = self._storage
+        device = storage._device
+        tensors = storage._tensors
         meta = []
-        for spec in self._storage._meta_specs:
-            meta.append(episode[spec.name][idx - 1])
-        obs = episode['observation'][idx - 1]
-        action = episode['action'][idx]
-        next_obs = episode['observation'][idx + self._nstep - 1]
-        reward = np.zeros_like(episode['reward'][idx])
-        discount = np.ones_like(episode['discount'][idx])
-        for i in range(self._nstep):
-            step_reward = episode['reward'][idx + i]
-            reward += discount * step_reward
-            discount *= episode['discount'][idx + i] * self._discount
+        for spec in storage._meta_specs:
+            meta.append(tensors[spec.name][idx - 1])
+        obs = self._take_obs(idx - 1, offsets)
+        action = tensors['action'][idx]
+        next_obs = self._take_obs(idx + self._nstep - 1, offsets)
+        steps = idx[:, None] + torch.arange(self._nstep, device=device)
+        step_reward = tensors['reward'][steps]
+        step_discount = tensors['discount'][steps] * self._discount
+        # discount accumulated before each step of the n-step return
+        discounts = torch.cumprod(step_discount, dim=1)
+        discount = discounts[:, -1]
+        discounts = torch.cat(
+            [torch.ones_like(discounts[:, :1]), discounts[:, :-1]], dim=1)
+        reward = (discounts * step_reward).sum(dim=1)
         return (obs, action, reward, discount, next_obs, *meta)
 
     def __iter__(self):
@@ -175,20 +838,48 @@ def _worker_init_fn(worker_id):
     random.seed(seed)
 
 
-def make_replay_loader(storage, max_size, batch_size, num_workers,
-                       save_snapshot, nstep, discount):
-    max_size_per_worker = max_size // max(1, num_workers)
+def make_replay_loader(storage,
+                       max_size,
+                       batch_size,
+                       num_workers,
+                       save_snapshot,
+                       nstep,
+                       discount,
+                       prioritized=False,
+                       alpha=0.6,
+                       beta=0.4):
+    if isinstance(storage, DeviceReplayBufferStorage):
+        return DeviceReplayBuffer(storage, batch_size, nstep, discount,
+                                  prioritized, alpha, beta)
+    if prioritized:
+        # priority updates have to reach the sampler, which only happens
+        # in-process
+        raise NotImplementedError(
+            'prioritized replay needs replay_buffer_format=device')
+    if isinstance(storage, RingReplayBufferStorage):
+        # workers share the storage arrays, no need to shard the episodes
+        iterable = RingReplayBuffer(storage,
+                                    max_size,
+                                    num_workers,
+                                    batch_size,
+                                    nstep,
+                                    discount,
+                                    fetch_every=1000)
+    else:
+        max_size_per_worker = max_size // max(1, num_workers)
 
-    iterable = ReplayBuffer(storage,
-                            max_size_per_worker,
-                            num_workers,
-                            nstep,
-                            discount,
-                            fetch_every=1000,
-                            save_snapshot=save_snapshot)
+        iterable = ReplayBuffer(storage,
+                                max_size_per_worker,
+                                num_workers,
+                                batch_size,
+                                nstep,
+                                discount,
+                                fetch_every=1000,
+                                save_snapshot=save_snapshot)
 
+    # the buffers yield ready-made batches
     loader = torch.utils.data.DataLoader(iterable,
-                                         batch_size=batch_size,
+                                         batch_size=None,
                                          num_workers=num_workers,
                                          pin_memory=True,
                                          worker_init_fn=_worker_init_fn)
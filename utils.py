@@ -41,15 +41,24 @@ def chain(*iterables):
         yield from it
 
 
+@torch.no_grad()
 def soft_update_params(net, target_net, tau):
-    for param, target_param in zip(net.parameters(), target_net.parameters()):
-        target_param.data.copy_(tau * param.data +
-                                (1 - tau) * target_param.data)
+    # target += tau * (param - target) over the whole net, one multi-tensor
+    # kernel per device and dtype instead of one copy per parameter
+    params = list(net.parameters())
+    target_params = list(target_net.parameters())
+    assert len(params) == len(target_params)
+    if params:
+        torch._foreach_lerp_(target_params, params, tau)
 
 
+@torch.no_grad()
 def hard_update_params(net, target_net):
-    for param, target_param in zip(net.parameters(), target_net.parameters()):
-        target_param.data.copy_(param.data)
+    params = list(net.parameters())
+    target_params = list(target_net.parameters())
+    assert len(params) == len(target_params)
+    if params:
+        torch._foreach_copy_(target_params, params)
 
 
 def to_torch(xs, device):
@@ -67,6 +76,11 @@ def weight_init(m):
         nn.init.orthogonal_(m.weight.data, gain)
         if hasattr(m.bias, 'data'):
             m.bias.data.fill_(0.0)
+    elif isinstance(m, EnsembleLinear):
+        for weight in m.weight.data:
+            nn.init.orthogonal_(weight)
+        if hasattr(m.bias, 'data'):
+            m.bias.data.fill_(0.0)
 
 
 def grad_norm(params, norm_type=2.0):
@@ -101,11 +115,12 @@ class Every:
         self._every = every
         self._action_repeat = action_repeat
 
-    def __call__(self, step):
+    def __call__(self, step, num_steps=1):
+        # whether any of the num_steps steps starting at step is due
         if self._every is None:
             return False
         every = self._every // self._action_repeat
-        if step % every == 0:
+        if (step + num_steps - 1) // every > (step - 1) // every:
             return True
         return False
 
@@ -254,6 +269,140 @@ class RandomShiftsAug(nn.Module):
                              align_corners=False)
 
 
+class RandomCropAug(nn.Module):
+    """the same random shifts as RandomShiftsAug, as an integer gather on
+    the (uint8) frames, clamping the indices stands in for the replicate
+    padding"""
+    def __init__(self, pad):
+        super().__init__()
+        self.pad = pad
+
+    def forward(self, x):
+        n, c, h, w = x.size()
+        assert h == w
+        shift = torch.randint(-self.pad,
+                              self.pad + 1,
+                              size=(n, 2),
+                              device=x.device)
+        arange = torch.arange(h, device=x.device)
+        cols = (arange + shift[:, :1]).clamp_(0, w - 1)
+        rows = (arange + shift[:, 1:]).clamp_(0, h - 1)
+        idx = torch.arange(n, device=x.device)[:, None, None]
+        # n x h x w x c, the channels move back in front after the gather
+        x = x.permute(0, 2, 3, 1)[idx, rows[:, :, None], cols[:, None, :]]
+        return x.permute(0, 3, 1, 2).float()
+
+
+def make_aug(aug, pad=4):
+    if aug == 'shift':
+        return RandomShiftsAug(pad)
+    elif aug == 'crop':
+        return RandomCropAug(pad)
+    raise ValueError(f'unknown aug: {aug}')
+
+
+class EnsembleLinear(nn.Module):
+    """n_models independent linear layers as one stacked weight
+    (n_models, out_features, in_features) and one batched matmul. the input
+    is (n_models, batch, in_features), or (batch, in_features) shared by
+    all members, the output (n_models, batch, out_features). each member is
+    initialized like nn.Linear"""
+    def __init__(self, in_features, out_features, n_models, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.n_models = n_models
+        self.weight = nn.Parameter(
+            torch.empty(n_models, out_features, in_features))
+        if bias:
+            self.bias = nn.Parameter(torch.empty(n_models, 1, out_features))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        bound = 1 / math.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        if self.bias is not None:
+            nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.expand(self.n_models, *x.shape)
+        weight = self.weight.transpose(1, 2)
+        if self.bias is None:
+            return torch.bmm(x, weight)
+        return torch.baddbmm(self.bias, x, weight)
+
+    def extra_repr(self):
+        return (f'in_features={self.in_features}, '
+                f'out_features={self.out_features}, '
+                f'n_models={self.n_models}, bias={self.bias is not None}')
+
+
+class FeatureCache:
+    """memoizes fn(x) over one update so that the critic, actor and
+    intrinsic modules can share the augmented and encoded batch. an output
+    is only reused without grad, and only while x and the parameters of fn
+    (if it is a module, other functions must not have any) are unchanged,
+    optimizer steps bump their version counters"""
+    def __init__(self):
+        self._entries = dict()
+
+    def __call__(self, fn, x):
+        params = fn.parameters() if isinstance(fn, nn.Module) else ()
+        version = (x._version, tuple(p._version for p in params))
+        entry = self._entries.get((fn, id(x)))
+        if entry is not None and entry[1] == version and (
+                not torch.is_grad_enabled()):
+            # the same tensor is handed back so it can key the next lookup
+            out = entry[2]
+            return out.detach() if out.requires_grad else out
+        out = fn(x)
+        # x is kept so that its id is not reused
+        self._entries[(fn, id(x))] = (x, version, out)
+        return out
+
+
+class MixedPrecision:
+    """opt-in autocast for the agent updates, amp is None, 'bf16' or 'fp16'.
+    fp16 losses are scaled with a GradScaler, bf16 keeps the fp32 exponent
+    range and needs none, and it also runs on the cpu"""
+    def __init__(self, amp, device):
+        assert amp in (None, 'bf16', 'fp16'), f'unknown amp: {amp}'
+        self.enabled = amp is not None
+        self.device_type = torch.device(device).type
+        self.dtype = torch.float16 if amp == 'fp16' else torch.bfloat16
+        self.scaler = torch.amp.GradScaler(self.device_type,
+                                           enabled=amp == 'fp16')
+
+    def autocast(self):
+        return torch.autocast(self.device_type,
+                              dtype=self.dtype,
+                              enabled=self.enabled)
+
+    def backward(self, loss):
+        # backward ops run in the dtypes of their forward ops anyway
+        with torch.autocast(self.device_type, enabled=False):
+            self.scaler.scale(loss).backward()
+
+    def step(self, *optimizers):
+        # optimizers that are None are skipped, with fp16 an optimizer skips
+        # its step if its gradients hold an inf or nan
+        for optimizer in optimizers:
+            if optimizer is not None:
+                self.scaler.step(optimizer)
+        # one update per step sequence, the encoder is stepped by several
+        self.scaler.update()
+        self.stepped()
+
+    def stepped(self):
+        # autocast caches the half precision copies of the weights until the
+        # outermost autocast exits, they are stale after an optimizer step
+        if self.enabled:
+            torch.clear_autocast_cache()
+
+
 class RMS(object):
     """running mean and std """
     def __init__(self, device, epsilon=1e-4, shape=(1,)):
@@ -276,31 +425,191 @@ class RMS(object):
         return self.M, self.S
 
 
+@torch.no_grad()
+def _knn_topk(source, target, k, chunk_size):
+    # squared distances |s|^2 + |t|^2 - 2 s.t as one matmul per block of
+    # chunk_size x chunk_size, merged into a running top-k per source row
+    # so no more than a block of distances is alive at a time
+    source_sq = source.pow(2).sum(-1, keepdim=True)
+    target_sq = target.pow(2).sum(-1)
+    dists, indices = [], []
+    for i in range(0, source.size(0), chunk_size):
+        rows = source[i:i + chunk_size]
+        best_dist = best_idx = None
+        for j in range(0, target.size(0), chunk_size):
+            dist = torch.addmm(source_sq[i:i + chunk_size] +
+                               target_sq[None, j:j + chunk_size],
+                               rows,
+                               target[j:j + chunk_size].t(),
+                               alpha=-2)
+            dist, idx = dist.topk(min(k, dist.size(1)), dim=1, largest=False)
+            idx += j
+            if best_dist is not None:
+                dist = torch.cat([best_dist, dist], dim=1)
+                idx = torch.cat([best_idx, idx], dim=1)
+                dist, pos = dist.topk(k, dim=1, largest=False)
+                idx = idx.gather(1, pos)
+            best_dist, best_idx = dist, idx
+        dists.append(best_dist)
+        indices.append(best_idx)
+    return torch.cat(dists), torch.cat(indices)
+
+
+def knn(source, target, k, chunk_size=1024):
+    """euclidean distances (b1, k) from every source row to its k nearest
+    target rows, sorted ascending. the neighbours are picked on matmul
+    distances in fp32, the k distances are then recomputed directly so
+    that they match torch.norm(source - target) exactly"""
+    source, target = source.float(), target.float()
+    with torch.autocast(source.device.type, enabled=False):
+        _, idx = _knn_topk(source.detach(), target.detach(), k, chunk_size)
+        dist = torch.norm(source[:, None, :] - target[idx], dim=-1, p=2)
+    dist, _ = dist.sort(dim=1)
+    return dist
+
+
+class RepBank:
+    """ring buffer of the last capacity representations on the device, the
+    pbe neighbours are searched in it instead of in the batch only. with
+    num_lists > 0 it is an ivf index: k-means centroids are fit once the
+    bank holds num_lists * 32 entries and refit warm started every
+    refresh_every additions, new entries go to their nearest list when
+    added, and a query only scans the entries of its num_probes nearest
+    lists. without lists the search is exact"""
+    def __init__(self, capacity, dim, device, num_lists=0, num_probes=8,
+                 refresh_every=None, kmeans_iters=10, chunk_size=1024):
+        self.capacity = capacity
+        self.num_lists = num_lists
+        self.num_probes = min(num_probes, num_lists)
+        self.refresh_every = refresh_every or capacity // 4
+        self.kmeans_iters = kmeans_iters
+        self.chunk_size = chunk_size
+        self.reps = torch.zeros(capacity, dim, device=device)
+        self.lists = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.centroids = None
+        self.size = 0
+        self._ptr = 0
+        self._since_refresh = 0
+
+    def __len__(self):
+        return self.size
+
+    @torch.no_grad()
+    def add(self, rep):
+        rep = rep.detach().float()[-self.capacity:]
+        slots = torch.arange(self._ptr, self._ptr + rep.size(0),
+                             device=rep.device) % self.capacity
+        self.reps[slots] = rep
+        if self.centroids is not None:
+            self.lists[slots] = self._nearest_list(rep)
+        self._ptr = (self._ptr + rep.size(0)) % self.capacity
+        self.size = min(self.size + rep.size(0), self.capacity)
+        self._since_refresh += rep.size(0)
+
+        if self.num_lists > 0 and self.size >= 32 * self.num_lists and (
+                self.centroids is None
+                or self._since_refresh >= self.refresh_every):
+            self._fit()
+
+    def _nearest_list(self, rep):
+        dist = torch.addmm(self.centroids.pow(2).sum(-1), rep,
+                           self.centroids.t(), alpha=-2)
+        return dist.argmin(dim=1)
+
+    def _fit(self):
+        reps = self.reps[:self.size]
+        if self.centroids is None:
+            idx = torch.randperm(self.size, device=reps.device)
+            self.centroids = reps[idx[:self.num_lists]].clone()
+        for _ in range(self.kmeans_iters):
+            lists = self._nearest_list(reps)
+            sums = torch.zeros_like(self.centroids).index_add_(0, lists, reps)
+            counts = torch.bincount(lists, minlength=self.num_lists)
+            # empty lists keep their centroid
+            nonempty = counts > 0
+            self.centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        self.lists[:self.size] = self._nearest_list(reps)
+        self._since_refresh = 0
+
+    @torch.no_grad()
+    def _ivf_indices(self, source, k):
+        # the source rows are grouped by probed list, each list is scanned
+        # once for all the rows probing it
+        dist = torch.addmm(self.centroids.pow(2).sum(-1), source,
+                           self.centroids.t(), alpha=-2)
+        probes = dist.topk(self.num_probes, dim=1, largest=False)[1]
+        lists = self.lists[:self.size]
+        order = lists.argsort()
+        counts = torch.bincount(lists, minlength=self.num_lists)
+        starts = (counts.cumsum(0) - counts).tolist()
+        counts = counts.tolist()
+
+        b = source.size(0)
+        best_dist = source.new_full((b, self.num_probes, k), float('inf'))
+        best_idx = torch.zeros(b, self.num_probes, k, dtype=torch.long,
+                               device=source.device)
+        for l in probes.unique().tolist():
+            if counts[l] == 0:
+                continue
+            rows, pos = (probes == l).nonzero(as_tuple=True)
+            members = order[starts[l]:starts[l] + counts[l]]
+            dist, idx = _knn_topk(source[rows], self.reps[members], k,
+                                  self.chunk_size)
+            best_dist[rows, pos, :idx.size(1)] = dist
+            best_idx[rows, pos, :idx.size(1)] = members[idx]
+        best_dist, pos = best_dist.view(b, -1).topk(k, dim=1, largest=False)
+        idx = best_idx.view(b, -1).gather(1, pos)
+        # rows whose probed lists hold fewer than k entries are searched
+        # exhaustively
+        missing = best_dist[:, -1].isinf()
+        if missing.any():
+            idx[missing] = _knn_topk(source[missing], self.reps[:self.size],
+                                     k, self.chunk_size)[1]
+        return idx
+
+    def knn(self, source, k):
+        """distances (b, k) from source to its k nearest bank entries, like
+        knn() with the bank as the target"""
+        k = min(k, self.size)
+        if self.centroids is None:
+            return knn(source, self.reps[:self.size], k, self.chunk_size)
+        source = source.float()
+        with torch.autocast(source.device.type, enabled=False):
+            idx = self._ivf_indices(source.detach(), k)
+            dist = torch.norm(source[:, None, :] - self.reps[idx], dim=-1, p=2)
+        dist, _ = dist.sort(dim=1)
+        return dist
+
+
 class PBE(object):
     """particle-based entropy based on knn normalized by running mean """
-    def __init__(self, rms, knn_clip, knn_k, knn_avg, knn_rms, device):
+    def __init__(self, rms, knn_clip, knn_k, knn_avg, knn_rms, device,
+                 knn_chunk_size=1024, bank=None):
         self.rms = rms
         self.knn_rms = knn_rms
         self.knn_k = knn_k
         self.knn_avg = knn_avg
         self.knn_clip = knn_clip
+        self.knn_chunk_size = knn_chunk_size
+        # a RepBank to take the neighbours from instead of the batch
+        self.bank = bank
         self.device = device
 
     def __call__(self, rep, hyper_dist_fn=None):
         source = target = rep
         b1, b2 = source.size(0), target.size(0)
-        # (b1, 1, c) - (1, b2, c) -> (b1, 1, c) - (1, b2, c) -> (b1, b2, c) -> (b1, b2)
         if hyper_dist_fn:
-            sim_matrix = hyper_dist_fn(source)
+            # block-wise, only the k nearest are kept
+            reward = hyper_dist_fn(source, k=self.knn_k)  # (b1, k)
+        elif self.bank is not None:
+            # the batch is added first, so like in the batch a particle
+            # counts as its own neighbour
+            self.bank.add(target)
+            reward = self.bank.knn(source, self.knn_k)  # (b1, k)
         else:
-            sim_matrix = torch.norm(source[:, None, :].view(b1, 1, -1) -
-                                    target[None, :, :].view(1, b2, -1),
-                                    dim=-1,
-                                    p=2)
-        reward, _ = sim_matrix.topk(self.knn_k,
-                                    dim=1,
-                                    largest=False,
-                                    sorted=True)  # (b1, k)
+            # chunked, without the (b1, b2, c) difference tensor
+            reward = knn(source, target, self.knn_k,
+                         self.knn_chunk_size)  # (b1, k)
         if not self.knn_avg:  # only keep k-th nearest neighbor
             reward = reward[:, -1]
             reward = reward.reshape(-1, 1)  # (b1, 1)
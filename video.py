@@ -35,7 +35,9 @@ class VideoRecorder:
                                            width=self.render_size,
                                            camera_id=self.camera_id)
             else:
-                frame = env.render()
+                frame = env.render(height=self.render_size,
+                                   width=self.render_size,
+                                   camera_id=self.camera_id)
             self.frames.append(frame)
 
     def log_to_wandb(self):